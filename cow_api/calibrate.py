@@ -0,0 +1,145 @@
+"""
+Calibration hors ligne des seuils d'identification
+
+Compare des crops de museaux de test (non utilisés à l'enrôlement) aux embeddings
+de la base, calcule les distributions de similarités authentiques / imposteurs par
+blocs et recommande des seuils pour des taux de fausses acceptations visés.
+
+Structure attendue du dossier de test : <holdout_dir>/<cow_id>/*.jpg
+(un cow_id absent de la base est traité comme un imposteur pour toutes les vaches)
+
+Exemples :
+    python calibrate.py --holdout-dir holdout_crops
+    python calibrate.py --holdout-dir holdout_crops --target-far 0.01 0.001 --per-cow --apply
+    python calibrate.py --gallery-only --target-far 0.001
+"""
+import argparse
+import json
+import os
+import logging
+from datetime import datetime, timezone
+import cv2
+import numpy as np
+from dotenv import load_dotenv
+from utils.calibration import similarity_histograms, recommend_thresholds, DEFAULT_BINS, DEFAULT_PER_COW_BINS
+
+load_dotenv(override=True)
+logging.basicConfig(level=logging.INFO)
+
+
+def load_holdout_crops(holdout_dir):
+    """Liste (cow_id, chemin) des crops de test"""
+    crops = []
+    for cow_id in sorted(os.listdir(holdout_dir)):
+        cow_dir = os.path.join(holdout_dir, cow_id)
+        if not os.path.isdir(cow_dir):
+            continue
+        for filename in sorted(os.listdir(cow_dir)):
+            if filename.lower().endswith(('.jpg', '.jpeg', '.png')):
+                crops.append((cow_id, os.path.join(cow_dir, filename)))
+    return crops
+
+
+def embed_crops(crops, batch_size):
+    """Embeddings des crops de test, calculés par lots"""
+    from utils.image_utils import load_and_preprocess_image
+    from utils.embeddings import get_embeddings
+
+    labels, chunks = [], []
+    for start in range(0, len(crops), batch_size):
+        tensors = []
+        for cow_id, path in crops[start:start + batch_size]:
+            img = cv2.imread(path)
+            if img is None:
+                logging.warning(f"Impossible de lire {path}")
+                continue
+            tensors.append(load_and_preprocess_image(img))
+            labels.append(cow_id)
+        if tensors:
+            chunks.append(get_embeddings(tensors, batch_size=batch_size))
+        logging.info(f"Embeddings: {min(start + batch_size, len(crops))}/{len(crops)}")
+    embeddings = np.concatenate(chunks, axis=0) if chunks else np.zeros((0, 0), dtype=np.float32)
+    return embeddings, labels
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibration hors ligne des seuils d'identification")
+    parser.add_argument("--holdout-dir", help="Dossier des crops de test (<cow_id>/*.jpg)")
+    parser.add_argument("--gallery-only", action="store_true",
+                        help="Sans crops de test : distribution imposteur vache contre vache de la base uniquement")
+    parser.add_argument("--target-far", type=float, nargs="+", default=[0.01, 0.001],
+                        help="Taux de fausses acceptations visés (le premier sert aux seuils par vache et à --apply)")
+    parser.add_argument("--block-size", type=int, default=1024, help="Taille des blocs du produit matriciel")
+    parser.add_argument("--batch-size", type=int, default=32, help="Taille des lots pour le calcul des embeddings")
+    parser.add_argument("--bins", type=int, default=DEFAULT_BINS, help="Nombre de bins des histogrammes sur [0, 1]")
+    parser.add_argument("--per-cow", action="store_true", help="Calculer aussi un seuil par vache")
+    parser.add_argument("--per-cow-bins", type=int, default=DEFAULT_PER_COW_BINS,
+                        help="Nombre de bins des histogrammes par vache (mémoire : vaches x bins x 8 octets)")
+    parser.add_argument("--apply", action="store_true", help="Enregistrer les seuils dans la base (S3)")
+    parser.add_argument("--output", help="Fichier JSON du rapport")
+    args = parser.parse_args()
+
+    if not args.holdout_dir and not args.gallery_only:
+        parser.error("--holdout-dir ou --gallery-only est requis")
+
+    from utils.db_sync import VersionedDatabase
+    versioned_db = VersionedDatabase()
+    versioned_db.load()
+    store = versioned_db.store
+    if len(store) == 0:
+        parser.error("La base de données est vide")
+
+    gallery_labels = store.labels
+    gallery = np.stack([store.get_embedding(label) for label in gallery_labels])
+    logging.info(f"Galerie: {len(gallery_labels)} vaches (version {versioned_db.version})")
+
+    if args.gallery_only:
+        queries, query_labels = gallery, gallery_labels
+    else:
+        crops = load_holdout_crops(args.holdout_dir)
+        if not crops:
+            parser.error(f"Aucun crop trouvé dans {args.holdout_dir}")
+        queries, query_labels = embed_crops(crops, args.batch_size)
+        logging.info(f"{len(query_labels)} crops de test")
+
+    histograms = similarity_histograms(
+        queries, query_labels, gallery, gallery_labels,
+        block_size=args.block_size, bins=args.bins,
+        per_cow=args.per_cow, exclude_self=args.gallery_only, per_cow_bins=args.per_cow_bins
+    )
+    recommendations = recommend_thresholds(histograms, target_fars=args.target_far)
+
+    per_cow = {gallery_labels[row]: threshold for row, threshold in recommendations.pop("per_cow", {}).items()}
+    report = {
+        "database_version": versioned_db.version,
+        "gallery_size": len(gallery_labels),
+        "queries": len(query_labels),
+        **recommendations,
+        "per_cow_thresholds": per_cow if args.per_cow else None
+    }
+    print(json.dumps(report, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        logging.info(f"Rapport écrit dans {args.output}")
+
+    if args.apply:
+        best = recommendations["global"][0]
+        if best["threshold"] is None:
+            parser.error("Aucun seuil global calculable (pas de paires imposteurs)")
+        calibration = {
+            "threshold": best["threshold"],
+            "target_far": best["target_far"],
+            "far": best.get("far"),
+            "frr": best.get("frr"),
+            "genuine_pairs": recommendations["genuine_pairs"],
+            "impostor_pairs": recommendations["impostor_pairs"],
+            "calibrated_at": datetime.now(timezone.utc).isoformat()
+        }
+        saved = versioned_db.set_calibration(per_cow, calibration)
+        logging.info(f"Seuils enregistrés dans la base (version {versioned_db.version}): {'OK' if saved else 'ÉCHEC'}")
+
+
+if __name__ == "__main__":
+    main()
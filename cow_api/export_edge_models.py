@@ -0,0 +1,44 @@
+"""
+Export des modèles au format ONNX pour le profil edge (RUNTIME_PROFILE=edge)
+
+À lancer sur une machine de développement avec les dépendances complètes
+(requirements.txt) et tf2onnx :
+    pip install tf2onnx
+    python export_edge_models.py
+
+Produit le détecteur YOLO (utils/new.onnx) et l'embedder Keras, sans sa couche de
+classification (utils/muzzle_embedding.onnx), chargés par EdgeInference.
+"""
+import argparse
+import os
+import shutil
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export ONNX des modèles pour le profil edge")
+    parser.add_argument("--imgsz", type=int, default=640, help="Taille d'entrée du détecteur")
+    parser.add_argument("--opset", type=int, default=13, help="Version d'opset ONNX")
+    parser.add_argument("--detector-output", default="utils/new.onnx")
+    parser.add_argument("--embedding-output", default="utils/muzzle_embedding.onnx")
+    args = parser.parse_args()
+
+    from ultralytics import YOLO
+    exported = YOLO("utils/new.pt").export(format="onnx", imgsz=args.imgsz, opset=args.opset)
+    if os.path.abspath(exported) != os.path.abspath(args.detector_output):
+        shutil.move(exported, args.detector_output)
+    logging.info(f"Détecteur exporté: {args.detector_output}")
+
+    import tensorflow as tf
+    import tf2onnx
+    from utils.embeddings import embedding_model
+    signature = (tf.TensorSpec((None, 224, 224, 3), tf.float32, name="input"),)
+    tf2onnx.convert.from_keras(embedding_model, input_signature=signature, opset=args.opset,
+                               output_path=args.embedding_output)
+    logging.info(f"Embedder exporté: {args.embedding_output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""
+Rapport d'empreinte du démarrage de l'API : durée, RSS et modules importés à chaque étape
+
+Charge l'API comme uvicorn (stockage, base, modèles) puis affiche le rapport JSON.
+Code de sortie 1 si la RSS dépasse le budget ou si un module lourd interdit est importé,
+à lancer en CI pour détecter les régressions du profil edge.
+
+Exemples :
+    python footprint.py
+    RUNTIME_PROFILE=edge python footprint.py --budget-mb 600 --forbid tensorflow torch ultralytics sklearn
+    python -X importtime footprint.py 2> imports.log   # détail du temps d'import par module
+"""
+import argparse
+import importlib
+import json
+import sys
+from utils.footprint import footprint
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Empreinte mémoire du démarrage de l'API")
+    parser.add_argument("--budget-mb", type=float, help="RSS maximale après démarrage (défaut: FOOTPRINT_BUDGET_MB)")
+    parser.add_argument("--forbid", nargs="*", default=[], help="Modules qui ne doivent pas être importés")
+    parser.add_argument("--output", help="Fichier JSON du rapport")
+    args = parser.parse_args()
+
+    importlib.import_module("main")
+    report = footprint.report(args.budget_mb)
+    report["forbidden_modules_loaded"] = sorted(set(args.forbid).intersection(
+        name.split(".")[0] for name in sys.modules
+    ))
+    print(json.dumps(report, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if report["within_budget"] is False or report["forbidden_modules_loaded"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
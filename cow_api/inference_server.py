@@ -0,0 +1,14 @@
+"""
+Serveur d'inférence : pool de processus qui chargent les modèles (YOLO + Keras)
+
+Les processus de l'API (INFERENCE_MODE=server) ne chargent aucun modèle et lui
+envoient les images via la mémoire partagée. À lancer sur la même machine que l'API :
+
+    python inference_server.py
+    INFERENCE_WORKERS=4 INFERENCE_THREADS_PER_WORKER=2 python inference_server.py
+    INFERENCE_MODE=server uvicorn main:app --workers 4
+"""
+from utils.inference_server import main
+
+if __name__ == "__main__":
+    main()
@@ -1,51 +1,72 @@
-from fastapi import FastAPI, File, UploadFile, Form
+# Importé en premier : référence de l'empreinte mémoire du démarrage (GET /footprint)
+from utils.footprint import footprint
+from fastapi import FastAPI, File, UploadFile, Form, Query
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 import os
-import shutil
 import numpy as np
-from utils.image_utils import load_and_preprocess_image, detect_muzzle
-from utils.embeddings import get_embedding, predict_identity
-from utils.s3_database import db_manager, load_database, save_database
+from utils.inference import create_inference
+from utils.embedding_store import match_identity
+from utils.inference_server import InferenceError
+from utils.s3_database import db_manager
 from utils.aws_utils import S3Manager
+from utils.storage import get_storage
+from utils.image_store import TieredImageStore
+from utils.db_sync import VersionedDatabase, DatabaseConflict
+from utils.quality import QualityGate
+from utils.dedup import find_enrollment_conflicts, audit_duplicates, duplicate_threshold
+from utils.result_cache import PredictionCache, content_hash, model_version
+from starlette.concurrency import run_in_threadpool
 import cv2
 import logging
 from dotenv import load_dotenv
 from datetime import datetime
 import sys
+import time
+from typing import Optional
 
 # Charger les variables d'environnement
 load_dotenv(override=True)
 
 # Configuration des logs
 logging.basicConfig(level=logging.INFO)
+footprint.mark("imports")
+
+# Profil d'exécution : standard, ou edge (boîtiers 2 Go : ONNX Runtime seul, embeddings mappés en mémoire)
+RUNTIME_PROFILE = os.getenv('RUNTIME_PROFILE', 'standard').lower()
 
 # Debug: Vérifier les credentials
 logging.info(f"🔑 Access Key: {os.getenv('AWS_ACCESS_KEY_ID')}")
 logging.info(f"🌍 Region: {os.getenv('AWS_REGION')}")
 
-# Vérification critique de S3 au démarrage
+# Vérification critique du stockage au démarrage (S3 par défaut, STORAGE_BACKEND=local|memory pour les tests)
 try:
-    logging.info("🔍 Vérification de la connectivité S3...")
+    storage = get_storage()
+    logging.info(f"🔍 Vérification de la connectivité du stockage ({storage.backend_name})...")
     
     # Vérifier les variables d'environnement AWS
-    required_vars = ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY']
-    missing_vars = [var for var in required_vars if not os.getenv(var)]
-    
-    if missing_vars:
-        raise Exception(f"Variables d'environnement manquantes: {', '.join(missing_vars)}")
+    if storage.backend_name == "s3":
+        required_vars = ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY']
+        missing_vars = [var for var in required_vars if not os.getenv(var)]
+        
+        if missing_vars:
+            raise Exception(f"Variables d'environnement manquantes: {', '.join(missing_vars)}")
+    else:
+        storage.ensure_bucket()
     
-    # Tester la connexion S3
-    s3_manager = S3Manager()
-    s3_manager.s3_client.head_bucket(Bucket=s3_manager.bucket_name)
+    # Tester la connexion au stockage
+    s3_manager = S3Manager(storage=storage)
+    s3_manager.check_access()
     
-    logging.info("✅ S3 accessible - démarrage de l'API")
+    logging.info(f"✅ Stockage {storage.backend_name} accessible - démarrage de l'API")
     
 except Exception as e:
-    logging.critical(f"❌ ERREUR S3: {e}")
-    logging.critical("🚫 L'API ne peut pas démarrer sans accès S3")
+    logging.critical(f"❌ ERREUR STOCKAGE: {e}")
+    logging.critical("🚫 L'API ne peut pas démarrer sans accès au stockage")
     sys.exit(1)
 
+footprint.mark("storage")
+
 app = FastAPI()
 
 # Configuration CORS
@@ -58,8 +79,14 @@ app.add_middleware(
 )
 
 # Charger la base de données depuis S3 au démarrage
-database = load_database()
-logging.info(f"Base de données chargée avec {len(database.get('labels', []))} vaches")
+# (index label -> ligne en mémoire pour des recherches/suppressions en O(1), versionnée pour
+# les rechargements incrémentaux ; chaque requête lit versioned_db.store une seule fois)
+# En profil edge, la matrice des embeddings est servie depuis une copie locale mappée en mémoire
+mmap_dir = os.getenv('EMBEDDINGS_MMAP_DIR') or ("embeddings_cache" if RUNTIME_PROFILE == "edge" else None)
+versioned_db = VersionedDatabase(db_manager, mmap_dir=mmap_dir)
+versioned_db.load()
+logging.info(f"Base de données chargée avec {len(versioned_db.store)} vaches (version {versioned_db.version})")
+footprint.mark("database")
 
 # Initialisation du gestionnaire S3 (déjà vérifié au démarrage)
 # s3_manager déjà initialisé lors de la vérification
@@ -74,12 +101,85 @@ except Exception as e:
     logging.error(f"Impossible d'initialiser S3: {e}")
     # L'application peut continuer, mais les uploads échoueront
 
+# Images brutes et museaux : cache disque local (LRU) devant S3, index des museaux en mémoire
+image_store = TieredImageStore(storage=storage)
+footprint.mark("image_store")
+
+
+
+
+def refresh_on_reload(result):
+    """Les museaux ajoutés/supprimés par d'autres nœuds deviennent visibles après un rechargement"""
+    if result["status"] in ("incremental", "full"):
+        image_store.refresh_index()
+
+
+versioned_db.add_listener(refresh_on_reload)
+
+# Cache des résultats de /predict (réessais des clients mobiles avec la même image)
+prediction_cache = PredictionCache()
+
+
+def clear_prediction_cache(result):
+    """/add-cow, DELETE /cow/{cow_id} et /database/reload invalident les prédictions en cache"""
+    if result["status"] != "unchanged":
+        prediction_cache.clear()
+
+
+versioned_db.add_listener(clear_prediction_cache)
+
+# Modèles chargés ici (INFERENCE_MODE=local, ONNX Runtime en profil edge) ou dans le serveur d'inférence (INFERENCE_MODE=server)
+inference = create_inference(profile=RUNTIME_PROFILE)
+MODEL_VERSION = model_version(inference.model_files)
+footprint.mark("models")
+
+startup_footprint = footprint.report()
+if startup_footprint["within_budget"] is False:
+    logging.error(f"⚠️ Empreinte mémoire au démarrage ({startup_footprint['rss_mb']} Mo) au-delà du budget FOOTPRINT_BUDGET_MB ({startup_footprint['budget_mb']} Mo)")
+
+
+async def run_inference(method, *args):
+    """En mode serveur, l'attente de la réponse ne bloque pas la boucle d'événements"""
+    if inference.remote:
+        return await run_in_threadpool(method, *args)
+    return method(*args)
+
+
+@app.on_event("startup")
+def start_database_polling():
+    """Rechargement périodique optionnel (DB_POLL_INTERVAL secondes) pour que les nœuds convergent"""
+    versioned_db.start_polling()
+
+
+@app.on_event("shutdown")
+def flush_image_store():
+    """Attendre l'envoi des museaux en attente avant l'arrêt"""
+    versioned_db.stop_polling()
+    image_store.shutdown()
+
 @app.post("/add-cow")
-async def add_cow(cow_id: str = Form(...)):
-    global database
+async def add_cow(
+    cow_id: str = Form(...),
+    replace: bool = Form(False, description="Réenrôler une vache déjà présente dans la base"),
+    reject_duplicates: bool = Form(False, description="Refuser l'enrôlement si le museau correspond à une autre vache"),
+    duplicate_similarity: Optional[float] = Form(None, description="Similarité de détection des doublons (défaut: DUPLICATE_SIMILARITY_THRESHOLD)")
+):
     embeddings = []
+    muzzle_crops = []
+    # Rapport par image (raison du rejet éventuel) et filtre qualité avant embedding
+    images_report = []
+    quality_gate = QualityGate()
+    quality_enabled = os.getenv('QUALITY_GATE_ENABLED', '1') != '0'
 
     try:
+        # Vérifier que l'identifiant n'est pas déjà utilisé (sauf réenrôlement explicite)
+        cow_exists = cow_id in versioned_db.store
+        if cow_exists and not replace:
+            return JSONResponse(status_code=409, content={
+                "error": f"La vache {cow_id} existe déjà dans la base de données. Utiliser replace=true pour la réenrôler.",
+                "cow_id": cow_id
+            })
+
         # Récupérer la liste des images depuis S3 pour cette vache
         s3_images = s3_manager.list_cow_raw_images(cow_id)
         
@@ -90,82 +190,107 @@ async def add_cow(cow_id: str = Form(...)):
 
         logging.info(f"Traitement de {len(s3_images)} images pour la vache {cow_id}")
 
-        # Créer un dossier temporaire local pour le traitement
-        temp_folder = f"temp_processing_{cow_id}"
-        os.makedirs(temp_folder, exist_ok=True)
-        
-        # Créer un dossier local pour sauvegarder les museaux détectés
-        muzzle_folder = f"muzzle_images/{cow_id}"
-        os.makedirs(muzzle_folder, exist_ok=True)
-
-        try:
-            muzzle_count = 0
-            for i, s3_image_key in enumerate(s3_images):
-                # Télécharger l'image depuis S3
-                local_image_path = os.path.join(temp_folder, f"image_{i}.jpg")
-                success = s3_manager.download_image(s3_image_key, local_image_path)
-                
-                if not success:
-                    logging.warning(f"Échec du téléchargement de {s3_image_key}")
-                    continue
-
-                # Charger et traiter l'image
-                img_cv = cv2.imread(local_image_path)
-                if img_cv is None:
-                    logging.warning(f"Impossible de charger l'image {local_image_path}")
+        muzzles_detected = 0
+        for s3_image_key in s3_images:
+            # Lire l'image via le cache local (téléchargée depuis S3 si absente)
+            image_bytes = image_store.get_raw_image(s3_image_key)
+            
+            if image_bytes is None:
+                logging.warning(f"Échec du téléchargement de {s3_image_key}")
+                images_report.append({"image": s3_image_key, "status": "rejected", "reason": "téléchargement échoué"})
+                continue
+
+            # Décoder à résolution réduite et détecter le museau (crop à la résolution utile)
+            muzzle_img, detection = await run_inference(inference.detect, image_bytes, 0.1)
+            if not detection["decoded"]:
+                logging.warning(f"Impossible de charger l'image {s3_image_key}")
+                images_report.append({"image": s3_image_key, "status": "rejected", "reason": "format non supporté"})
+                continue
+            if muzzle_img is None or muzzle_img.size == 0:
+                logging.info(f"Museau non détecté dans l'image {s3_image_key}")
+                images_report.append({"image": s3_image_key, "status": "rejected", "reason": "museau non détecté"})
+                continue
+
+            muzzles_detected += 1
+
+            # Filtre qualité rapide (taille, netteté, exposition, quasi-doublons) avant l'embedding
+            if quality_enabled:
+                accepted, reason, metrics = quality_gate.evaluate(muzzle_img, s3_image_key)
+                if not accepted:
+                    logging.info(f"Museau rejeté ({s3_image_key}): {reason}")
+                    images_report.append({"image": s3_image_key, "status": "rejected", "reason": reason, "quality": metrics})
                     continue
+                images_report.append({"image": s3_image_key, "status": "accepted", "quality": metrics})
+            else:
+                images_report.append({"image": s3_image_key, "status": "accepted"})
 
-                # Détecter le museau
-                muzzle_img = detect_muzzle(img_cv, 0.1)
-                if muzzle_img is None:
-                    logging.info(f"Museau non détecté dans l'image {s3_image_key}")
-                    continue
+            # Image du museau gardée en mémoire : envoyée seulement si l'enrôlement est accepté
+            encoded, muzzle_buffer = cv2.imencode(".jpg", muzzle_img)
+            if encoded:
+                muzzle_crops.append(muzzle_buffer.tobytes())
 
-                # Sauvegarder l'image du museau localement
-                muzzle_filename = f"muzzle_{cow_id}_{muzzle_count:03d}.jpg"
-                muzzle_path = os.path.join(muzzle_folder, muzzle_filename)
-                cv2.imwrite(muzzle_path, muzzle_img)
-                muzzle_count += 1
-                logging.info(f"Museau sauvegardé: {muzzle_path}")
-
-                # Traitement pour les embeddings seulement (pas de sauvegarde)
-                img_tensor = load_and_preprocess_image(muzzle_img)
-                emb = get_embedding(img_tensor)
-                embeddings.append(emb)
-                logging.info(f"Embedding extrait de {s3_image_key}")
-
-        finally:
-            # Nettoyage du dossier temporaire local
-            try:
-                shutil.rmtree(temp_folder)
-                logging.info(f"Dossier temporaire {temp_folder} supprimé")
-            except Exception as e:
-                logging.warning(f"Impossible de supprimer le dossier temporaire {temp_folder}: {e}")
+            # Embedding calculé seulement pour les crops acceptés par le filtre qualité
+            # (en mode serveur, le crop est transmis au worker par la mémoire partagée)
+            emb = await run_inference(inference.embed, muzzle_img)
+            embeddings.append(emb)
+            logging.info(f"Embedding extrait de {s3_image_key}")
 
         if len(embeddings) == 0:
             return JSONResponse(status_code=400, content={
-                "error": "Aucune image valide (museau non détecté) trouvée.",
-                "images_found": len(s3_images)
+                "error": "Aucune image valide (museau non détecté ou qualité insuffisante) trouvée.",
+                "images_found": len(s3_images),
+                "images_report": images_report
             })
 
         # Moyenne des embeddings et sauvegarde dans la base de données S3
         avg_embedding = np.mean(embeddings, axis=0)
-        database["labels"].append(cow_id)
-        database["embeddings"].append(avg_embedding.tolist())
-        
-        # Sauvegarder sur S3
-        save_success = save_database(database)
+
+        # Même animal déjà enregistré sous un autre identifiant ? (moyenne + chaque image, en un seul lot)
+        similarity_threshold = duplicate_similarity if duplicate_similarity is not None else duplicate_threshold()
+        conflicts = find_enrollment_conflicts(
+            versioned_db.store, [avg_embedding] + embeddings, cow_id, similarity_threshold
+        )
+        if conflicts:
+            logging.warning(f"Vache {cow_id}: doublon possible avec {[c['cow_id'] for c in conflicts]}")
+            if reject_duplicates:
+                return JSONResponse(status_code=409, content={
+                    "error": f"La vache {cow_id} correspond à une vache déjà enregistrée.",
+                    "duplicate_check": {"threshold": similarity_threshold, "conflicts": conflicts},
+                    "images_report": images_report
+                })
+
+        # Sauvegarder sur S3 (journal + base complète, version incrémentée)
+        _, save_success = versioned_db.add(cow_id, avg_embedding, {"images_count": len(embeddings)})
+
+        # Enrôlement accepté : remplacer les museaux d'un enrôlement précédent (cache local + envoi asynchrone sur S3)
+        replaced_crops = image_store.delete_muzzle_crops(cow_id)
+        if replaced_crops:
+            logging.info(f"Vache {cow_id}: {replaced_crops} anciens museaux supprimés")
+        for i, crop in enumerate(muzzle_crops):
+            muzzle_key = image_store.put_muzzle_crop(cow_id, f"muzzle_{cow_id}_{i:03d}.jpg", crop)
+            logging.info(f"Museau sauvegardé: {muzzle_key}")
         
         return {
-            "message": f"✅ Vache {cow_id} ajoutée avec {len(embeddings)} images valides (museau détecté).",
+            "message": f"✅ Vache {cow_id} ajoutée avec {len(embeddings)} images valides (museau détecté, qualité suffisante).",
             "images_found_in_s3": len(s3_images),
-            "images_with_muzzle_detected": len(embeddings),
+            "images_with_muzzle_detected": muzzles_detected,
+            "images_rejected": sum(1 for r in images_report if r["status"] == "rejected"),
             "embeddings_extracted": len(embeddings),
-            "muzzle_images_saved_to": muzzle_folder,
-            "muzzle_files_count": muzzle_count,
-            "database_saved_to_s3": save_success
+            "muzzle_images_saved_to": image_store.muzzle_location(cow_id),
+            "muzzle_files_count": len(muzzle_crops),
+            "database_saved_to_s3": save_success,
+            "replaced_existing": cow_exists,
+            "duplicate_check": {"threshold": similarity_threshold, "conflicts": conflicts},
+            "quality_thresholds": quality_gate.thresholds() if quality_enabled else None,
+            "images_report": images_report
         }
 
+    except DatabaseConflict as e:
+        logging.error(f"Écriture de la vache {cow_id} en conflit avec un autre nœud: {e}")
+        return JSONResponse(status_code=409, content={
+            "error": f"⚠️ La base de données a été modifiée en parallèle par un autre nœud, réessayer: {str(e)}",
+            "cow_id": cow_id
+        })
     except Exception as e:
         logging.error(f"Erreur lors du traitement de la vache {cow_id}: {e}")
         return JSONResponse(status_code=500, content={
@@ -177,9 +302,14 @@ async def add_cow(cow_id: str = Form(...)):
 @app.post("/predict", 
           summary="Prédiction d'identité de vache",
           description="Prédit l'identité d'une vache à partir d'une seule image. L'image doit contenir un museau de vache visible.")
-async def predict(image: UploadFile = File(..., description="Une seule image de vache (formats supportés: JPG, PNG, etc.)")):
+async def predict(
+    image: UploadFile = File(..., description="Une seule image de vache (formats supportés: JPG, PNG, etc.)"),
+    profile: bool = Query(False, description="Mesurer aussi l'ancien chemin (détection en pleine résolution) pour comparer les temps")
+):
     """Prédiction d'identité de vache à partir d'une seule image"""
-    global database
+    request_start = time.perf_counter()
+    # Version de la base figée pour toute la requête (un rechargement concurrent ne la modifie pas)
+    db_version, database = versioned_db.snapshot()
     
     # Validation du type de fichier
     if not image.content_type.startswith('image/'):
@@ -197,33 +327,54 @@ async def predict(image: UploadFile = File(..., description="Une seule image de
         )
     
     filename_only = os.path.basename(image.filename)
-    temp_path = f"temp_{filename_only}"
     
     try:
-        with open(temp_path, "wb") as buffer:
-            shutil.copyfileobj(image.file, buffer)
+        contents = await image.read()
     except Exception as e:
         return JSONResponse(
             status_code=400,
             content={"error": f"Erreur lors de la lecture du fichier: {str(e)}"}
         )
+    
+    if len(contents) > max_size:
+        return JSONResponse(
+            status_code=400,
+            content={"error": "La taille de l'image ne doit pas dépasser 10MB"}
+        )
+
+    # Même image déjà traitée avec la même base et les mêmes modèles : réponse immédiate
+    cache_key = (content_hash(contents), db_version, MODEL_VERSION)
+    cached = None if profile else prediction_cache.get(cache_key)
+    if cached is not None:
+        cached["original_filename"] = filename_only
+        cached["cached"] = True
+        return JSONResponse(cached)
 
+    # Décodage à résolution réduite, détection sur l'image réduite, crop à la résolution utile, embedding
     try:
-        img_cv = cv2.imread(temp_path)
-        if img_cv is None:
-            return JSONResponse(
-                status_code=400,
-                content={"error": "Impossible de lire l'image. Format non supporté."}
-            )
-    finally:
-        # Nettoyer le fichier temporaire même en cas d'erreur
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
-
-    # Détection du museau
-    muzzle_img = detect_muzzle(img_cv)
-    if muzzle_img is None:
-        return JSONResponse({
+        muzzle_found, detection, query_emb = await run_inference(inference.predict, contents)
+        full_detection = await run_inference(inference.detect_full_resolution, contents) if profile else None
+    except InferenceError as e:
+        logging.error(f"Erreur du serveur d'inférence: {e}")
+        return JSONResponse(status_code=503, content={"error": f"Serveur d'inférence indisponible: {str(e)}"})
+    if not detection["decoded"]:
+        return JSONResponse(
+            status_code=400,
+            content={"error": "Impossible de lire l'image. Format non supporté."}
+        )
+    timings = detection.pop("timings_ms")
+
+    def respond(result):
+        # Les temps ne sont pas mis en cache : ils décrivent cette requête
+        prediction_cache.put(cache_key, result)
+        timings["total"] = round((time.perf_counter() - request_start) * 1000, 2)
+        response = {**result, "detection": detection, "timings_ms": timings}
+        if full_detection is not None:
+            response["full_resolution_timings_ms"] = full_detection[1]["timings_ms"]
+        return JSONResponse(response)
+
+    if not muzzle_found:
+        return respond({
             "prediction": "MUSEAU NON DÉTECTÉ",
             "score": 0,
             "muzzle_saved": False
@@ -238,29 +389,32 @@ async def predict(image: UploadFile = File(..., description="Une seule image de
     # cv2.imwrite(muzzle_save_path, muzzle_img)
     # logging.info(f"Museau détecté sauvegardé: {muzzle_save_path}")
     
-    img_tensor = load_and_preprocess_image(muzzle_img)
-    label, score = predict_identity(img_tensor, database)
+    match_start = time.perf_counter()
+    label, score = match_identity(query_emb, database)
+    timings["match"] = round((time.perf_counter() - match_start) * 1000, 2)
 
     # Gestion du cas où la base de données est vide
     if label == "BASE_VIDE":
-        return JSONResponse({
+        result = {
             "prediction": "BASE DE DONNÉES VIDE",
             "score": 0.0,
             "muzzle_saved": True,
             # "muzzle_save_path": muzzle_save_path,
             "original_filename": filename_only,
             "message": "Aucune vache enregistrée dans la base de données. Ajoutez des vaches avec /add-cow avant de faire des prédictions.",
-            "total_cows_in_database": len(database.get("labels", []))
-        })
+            "total_cows_in_database": len(database)
+        }
+        return respond(result)
 
-    return JSONResponse({
+    result = {
         "prediction": label,
         "score": float(score),
         "muzzle_saved": True,
         # "muzzle_save_path": muzzle_save_path,
         "original_filename": filename_only,
-        "total_cows_in_database": len(database.get("labels", []))
-    })
+        "total_cows_in_database": len(database)
+    }
+    return respond(result)
 
 
 @app.get("/cow/{cow_id}/raw-images")
@@ -268,7 +422,7 @@ async def get_cow_raw_images(cow_id: str):
     """Récupère la liste des images brutes d'une vache stockées sur S3"""
     try:
         raw_keys = s3_manager.list_cow_raw_images(cow_id)
-        raw_urls = [f"https://{s3_manager.bucket_name}.s3.{s3_manager.region_name}.amazonaws.com/{key}" for key in raw_keys]
+        raw_urls = [s3_manager.image_url(key) for key in raw_keys]
         return {
             "cow_id": cow_id,
             "raw_images_count": len(raw_urls),
@@ -283,81 +437,48 @@ async def get_cow_raw_images(cow_id: str):
 
 @app.get("/cow/{cow_id}/muzzle-images")
 async def get_cow_muzzle_images(cow_id: str):
-    """Récupère la liste des images de museaux sauvegardées localement"""
-    muzzle_folder = f"muzzle_images/{cow_id}"
+    """Récupère la liste des images de museaux (depuis l'index, partagé via S3)"""
+    muzzle_files = image_store.list_muzzle_crops(cow_id)
     
-    if not os.path.exists(muzzle_folder):
+    if not muzzle_files:
         return JSONResponse(
             status_code=404,
             content={"error": f"Aucune image de museau trouvée pour la vache {cow_id}"}
         )
     
-    try:
-        muzzle_files = [f for f in os.listdir(muzzle_folder) if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
-        muzzle_files.sort()  # Tri par nom
-        
-        return {
-            "cow_id": cow_id,
-            "muzzle_images_count": len(muzzle_files),
-            "muzzle_folder": muzzle_folder,
-            "muzzle_files": muzzle_files
-        }
-    except Exception as e:
-        return JSONResponse(
-            status_code=500,
-            content={"error": f"Erreur lors de la lecture du dossier: {str(e)}"}
-        )
+    return {
+        "cow_id": cow_id,
+        "muzzle_images_count": len(muzzle_files),
+        "muzzle_folder": image_store.muzzle_location(cow_id),
+        "muzzle_files": muzzle_files
+    }
 
 
 @app.delete("/cow/{cow_id}")
 async def delete_cow(cow_id: str):
     """Supprime une vache et toutes ses images de la base de données d'embeddings"""
-    global database
+    database = versioned_db.store
     
     try:
-        # Vérifier si la vache existe dans la base de données
-        labels = database.get("labels", [])
-        embeddings = database.get("embeddings", [])
-        
-        if cow_id not in labels:
+        # Vérifier si la vache existe dans la base de données (index en O(1))
+        if cow_id not in database:
             return JSONResponse(
                 status_code=404,
                 content={"error": f"Vache {cow_id} non trouvée dans la base de données"}
             )
         
-        # Trouver l'index de la vache dans la base de données
-        cow_index = labels.index(cow_id)
-        
         # Créer une sauvegarde avant suppression
         backup_key = db_manager.backup_database()
         if not backup_key:
             logging.warning("Impossible de créer une sauvegarde avant suppression")
         
-        # Supprimer la vache et son embedding de la base de données
-        labels.pop(cow_index)
-        embeddings.pop(cow_index)
-        
-        # Mettre à jour la base de données globale
-        database["labels"] = labels
-        database["embeddings"] = embeddings
+        # Supprimer la vache et son embedding (tombstone, compaction automatique)
+        # puis sauvegarder la base de données mise à jour
+        _, save_success = versioned_db.remove(cow_id)
         
-        # Sauvegarder la base de données mise à jour
-        save_success = save_database(database)
-        
-        # Supprimer le dossier local des images de museaux s'il existe
-        muzzle_folder = f"muzzle_images/{cow_id}"
-        muzzle_files_deleted = 0
-        if os.path.exists(muzzle_folder):
-            try:
-                # Compter les fichiers avant suppression
-                muzzle_files = [f for f in os.listdir(muzzle_folder) if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
-                muzzle_files_deleted = len(muzzle_files)
-                
-                # Supprimer le dossier et son contenu
-                shutil.rmtree(muzzle_folder)
-                logging.info(f"Dossier de museaux {muzzle_folder} supprimé avec {muzzle_files_deleted} fichiers")
-            except Exception as e:
-                logging.warning(f"Impossible de supprimer le dossier {muzzle_folder}: {e}")
+        # Supprimer les images de museaux (cache local et S3)
+        muzzle_files_deleted = image_store.delete_muzzle_crops(cow_id)
+        logging.info(f"Museaux de la vache {cow_id} supprimés: {muzzle_files_deleted} fichiers")
         
         return {
             "message": f"✅ Vache {cow_id} supprimée avec succès",
@@ -365,12 +486,21 @@ async def delete_cow(cow_id: str):
             "embedding_removed": True,
             "database_saved_to_s3": save_success,
             "backup_created": backup_key is not None,
-            "backup_location": f"s3://{db_manager.bucket_name}/{backup_key}" if backup_key else None,
-            "muzzle_folder_deleted": os.path.exists(f"muzzle_images/{cow_id}") == False,
+            "backup_location": storage.uri(backup_key) if backup_key else None,
+            "muzzle_folder_deleted": image_store.count_muzzle_crops(cow_id) == 0,
             "muzzle_files_deleted": muzzle_files_deleted,
-            "remaining_cows_in_database": len(database.get("labels", []))
+            "remaining_cows_in_database": len(versioned_db.store)
         }
         
+    except DatabaseConflict as e:
+        logging.error(f"Suppression de la vache {cow_id} en conflit avec un autre nœud: {e}")
+        return JSONResponse(
+            status_code=409,
+            content={
+                "error": f"⚠️ La base de données a été modifiée en parallèle par un autre nœud, réessayer: {str(e)}",
+                "cow_id": cow_id
+            }
+        )
     except Exception as e:
         logging.error(f"Erreur lors de la suppression de la vache {cow_id}: {e}")
         return JSONResponse(
@@ -383,33 +513,30 @@ async def delete_cow(cow_id: str):
 
 
 @app.get("/cows")
-async def list_all_cows():
-    """Liste toutes les vaches présentes dans la base de données d'embeddings"""
+async def list_all_cows(offset: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=1000)):
+    """Liste paginée des vaches présentes dans la base de données d'embeddings"""
     try:
-        labels = database.get("labels", [])
-        embeddings = database.get("embeddings", [])
+        database = versioned_db.store
+        total_cows = len(database)
         
         cows_info = []
-        for i, cow_id in enumerate(labels):
-            # Vérifier si le dossier de museaux existe localement
-            muzzle_folder = f"muzzle_images/{cow_id}"
-            muzzle_files_count = 0
-            if os.path.exists(muzzle_folder):
-                muzzle_files = [f for f in os.listdir(muzzle_folder) if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
-                muzzle_files_count = len(muzzle_files)
-            
-            cows_info.append({
-                "cow_id": cow_id,
-                "index": i,
-                "has_embedding": i < len(embeddings),
-                "muzzle_folder_exists": os.path.exists(muzzle_folder),
+        for cow in database.page(offset, limit):
+            # Nombre de museaux depuis l'index (pas d'accès disque par vache)
+            muzzle_files_count = image_store.count_muzzle_crops(cow["cow_id"])
+            cow.update({
+                "has_embedding": True,
+                "muzzle_folder_exists": muzzle_files_count > 0,
                 "muzzle_files_count": muzzle_files_count
             })
+            cows_info.append(cow)
         
         return {
-            "total_cows": len(labels),
+            "total_cows": total_cows,
+            "offset": offset,
+            "limit": limit,
+            "next_offset": offset + limit if offset + limit < total_cows else None,
             "cows": cows_info,
-            "database_status": "loaded" if len(labels) > 0 else "empty"
+            "database_status": "loaded" if total_cows > 0 else "empty"
         }
         
     except Exception as e:
@@ -425,38 +552,92 @@ async def health_check():
     """Vérification de l'état de l'API et de la connectivité S3"""
     try:
         # Test de connectivité S3
-        s3_manager.s3_client.head_bucket(Bucket=s3_manager.bucket_name)
+        s3_manager.check_access()
         s3_status = "OK"
     except Exception as e:
         s3_status = f"ERROR: {str(e)}"
     
     # Informations sur la base de données
     db_info = db_manager.get_database_info()
+    database = versioned_db.store
     
     return {
         "api_status": "OK",
+        "storage_backend": storage.backend_name,
         "s3_status": s3_status,
         "bucket_name": s3_manager.bucket_name,
-        "database_loaded": len(database.get("labels", [])) > 0,
+        "database_loaded": len(database) > 0,
         "database_info": db_info,
-        "total_cows_in_database": len(database.get("labels", []))
+        "database_version": versioned_db.info(),
+        "image_store": image_store.stats(),
+        "prediction_cache": prediction_cache.stats(),
+        "model_version": MODEL_VERSION,
+        "inference": inference.stats(),
+        "total_cows_in_database": len(database)
+    }
+
+
+@app.get("/footprint")
+async def get_footprint():
+    """Empreinte du démarrage (durée, RSS et modules importés par étape) et RSS actuelle"""
+    return {
+        "runtime_profile": RUNTIME_PROFILE,
+        **footprint.report(),
+        # État de la base en service (mappée ou non depuis la dernière écriture / le dernier rechargement)
+        "embeddings": {
+            **versioned_db.store.stats(),
+            "version": versioned_db.version,
+            "mmap_dir": versioned_db.mmap_dir
+        }
     }
 
 
 @app.get("/database/info")
-async def get_database_info():
-    """Informations détaillées sur la base de données"""
-    db_info = db_manager.get_database_info()
+async def get_database_info(offset: int = Query(0, ge=0), limit: int = Query(1000, ge=1, le=10000)):
+    """Informations détaillées sur la base de données (liste des vaches paginée)"""
+    # Métadonnées mises en cache au chargement/à la sauvegarde (pas d'appel S3 par requête)
+    db_info = db_manager.get_database_info(use_cache=True)
+    database = versioned_db.store
+    total_cows = len(database)
     
     return {
-        "total_cows": len(database.get("labels", [])),
-        "cow_ids": database.get("labels", []),
-        "storage_location": f"s3://{db_manager.bucket_name}/{db_manager.db_key}",
+        "total_cows": total_cows,
+        "offset": offset,
+        "limit": limit,
+        "next_offset": offset + limit if offset + limit < total_cows else None,
+        "cow_ids": database.labels[offset:offset + limit],
+        "index_stats": database.stats(),
+        "calibration": database.calibration,
+        "database_version": versioned_db.info(),
+        "storage_location": db_manager.location,
         "local_cache": db_manager.local_cache,
         "database_details": db_info
     }
 
 
+@app.get("/database/audit")
+async def audit_database_duplicates(
+    threshold: Optional[float] = Query(None, description="Similarité minimale (défaut: DUPLICATE_SIMILARITY_THRESHOLD)"),
+    block_size: int = Query(1024, ge=16, le=8192),
+    max_pairs: int = Query(1000, ge=1, le=100000)
+):
+    """Recherche toutes les paires de vaches quasi identiques (doublons probables) dans la base"""
+    try:
+        # Produit matriciel par blocs, hors de la boucle d'événements
+        version, database = versioned_db.snapshot()
+        result = await run_in_threadpool(
+            audit_duplicates, database, threshold, block_size, max_pairs
+        )
+        result["database_version"] = version
+        return result
+    except Exception as e:
+        logging.error(f"Erreur lors de l'audit des doublons: {e}")
+        return JSONResponse(
+            status_code=500,
+            content={"error": f"Erreur lors de l'audit: {str(e)}"}
+        )
+
+
 @app.post("/database/backup")
 async def create_database_backup():
     """Créer une sauvegarde manuelle de la base de données"""
@@ -464,7 +645,7 @@ async def create_database_backup():
     if backup_key:
         return {
             "message": "Backup créé avec succès",
-            "backup_location": f"s3://{db_manager.bucket_name}/{backup_key}",
+            "backup_location": storage.uri(backup_key),
             "backup_key": backup_key
         }
     else:
@@ -475,15 +656,20 @@ async def create_database_backup():
 
 
 @app.post("/database/reload")
-async def reload_database():
-    """Recharge la base de données depuis S3"""
-    global database
+async def reload_database(force: bool = Query(False, description="Ignorer l'ETag et le journal, tout recharger")):
+    """Recharge la base de données depuis S3 si elle a changé (seulement les modifications depuis la version chargée)"""
     try:
-        database = load_database()
+        # Construction de la nouvelle version hors de la boucle d'événements
+        result = await run_in_threadpool(versioned_db.reload, force)
+        database = versioned_db.store
         return {
-            "message": "Base de données rechargée depuis S3",
-            "total_cows": len(database.get("labels", [])),
-            "cow_ids": database.get("labels", [])
+            "message": "Base de données rechargée depuis S3" if result["status"] != "unchanged" else "Base de données déjà à jour",
+            "reload_status": result["status"],
+            "from_version": result["from_version"],
+            "version": result["version"],
+            "changes_applied": result["changes_applied"],
+            "total_cows": len(database),
+            "cow_ids": database.labels
         }
     except Exception as e:
         return JSONResponse(
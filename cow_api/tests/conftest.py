@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Les modules de l'API s'importent depuis cow_api/ (from utils...), sans S3 ni modèles
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("STORAGE_BACKEND", "memory")
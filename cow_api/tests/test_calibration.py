@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+
+from utils.calibration import (
+    normalize_rows, similarity_histograms, false_accept_rates, false_reject_rates,
+    threshold_for_far, recommend_thresholds
+)
+
+
+def embeddings(n, seed, dim=6):
+    return np.random.default_rng(seed).normal(size=(n, dim)).astype(np.float32)
+
+
+def brute_force_histograms(queries, query_labels, gallery, gallery_labels, bins, per_cow_bins, exclude_self):
+    """Référence : matrice N x N complète, une paire à la fois"""
+    sims = normalize_rows(queries) @ normalize_rows(gallery).T
+    genuine = np.zeros(bins, dtype=np.int64)
+    impostor = np.zeros(bins, dtype=np.int64)
+    genuine_per_cow = np.zeros((len(gallery_labels), per_cow_bins), dtype=np.int64)
+    impostor_per_cow = np.zeros((len(gallery_labels), per_cow_bins), dtype=np.int64)
+    for i, q_label in enumerate(query_labels):
+        for j, g_label in enumerate(gallery_labels):
+            if exclude_self and i == j:
+                continue
+            b = int(np.clip(np.rint(sims[i, j] * (bins - 1)), 0, bins - 1))
+            c = int(np.clip(np.rint(sims[i, j] * (per_cow_bins - 1)), 0, per_cow_bins - 1))
+            if q_label == g_label:
+                genuine[b] += 1
+                genuine_per_cow[j, c] += 1
+            else:
+                impostor[b] += 1
+                impostor_per_cow[j, c] += 1
+    return genuine, impostor, genuine_per_cow, impostor_per_cow
+
+
+@pytest.mark.parametrize("block_size", [1, 2, 3, 7, 64])
+@pytest.mark.parametrize("exclude_self", [False, True])
+def test_blocked_histograms_match_brute_force(block_size, exclude_self):
+    gallery = embeddings(10, seed=1)
+    gallery_labels = [f"c{i}" for i in range(10)]
+    if exclude_self:
+        # Galerie comparée à elle-même : la diagonale est la seule paire authentique
+        queries, query_labels = gallery, gallery_labels
+    else:
+        queries = np.vstack([gallery[::2] + 0.1 * embeddings(5, seed=2), embeddings(3, seed=3)])
+        query_labels = gallery_labels[::2] + ["inconnue_1", "inconnue_2", "inconnue_3"]
+
+    result = similarity_histograms(queries, query_labels, gallery, gallery_labels, block_size=block_size,
+                                   bins=51, per_cow=True, exclude_self=exclude_self, per_cow_bins=11)
+    genuine, impostor, genuine_per_cow, impostor_per_cow = brute_force_histograms(
+        queries, query_labels, gallery, gallery_labels, 51, 11, exclude_self)
+
+    np.testing.assert_array_equal(result["genuine"], genuine)
+    np.testing.assert_array_equal(result["impostor"], impostor)
+    np.testing.assert_array_equal(result["genuine_per_cow"], genuine_per_cow)
+    np.testing.assert_array_equal(result["impostor_per_cow"], impostor_per_cow)
+    pairs = len(queries) * len(gallery) - (len(gallery) if exclude_self else 0)
+    assert result["genuine"].sum() + result["impostor"].sum() == pairs
+    if exclude_self:
+        assert result["genuine"].sum() == 0
+
+
+def hist(bins, counts):
+    h = np.zeros(bins, dtype=np.int64)
+    for b, n in counts.items():
+        h[b] = n
+    return h
+
+
+def test_far_and_frr_per_bin():
+    impostor = hist(11, {2: 6, 5: 3, 8: 1})
+    genuine = hist(11, {7: 1, 9: 3})
+
+    np.testing.assert_allclose(false_accept_rates(impostor), [1, 1, 1, .4, .4, .4, .1, .1, .1, 0, 0])
+    np.testing.assert_allclose(false_reject_rates(genuine), [0, 0, 0, 0, 0, 0, 0, 0, .25, .25, 1])
+
+
+def test_threshold_for_far():
+    impostor = hist(11, {2: 6, 5: 3, 8: 1})
+
+    assert threshold_for_far(impostor, 0.5) == pytest.approx(0.3)
+    assert threshold_for_far(impostor, 0.1) == pytest.approx(0.6)
+    assert threshold_for_far(impostor, 0.05) == pytest.approx(0.9)
+    assert threshold_for_far(impostor, 0.0) == pytest.approx(0.9)
+    # Imposteurs dans le dernier bin : aucun seuil ne les écarte tous
+    assert threshold_for_far(hist(11, {10: 5}), 0.0) == 1.0
+    assert threshold_for_far(hist(11, {}), 0.01) is None
+
+
+def test_recommend_thresholds():
+    histograms = {
+        "genuine": hist(11, {7: 1, 9: 3}),
+        "impostor": hist(11, {2: 6, 5: 3, 8: 1}),
+        "bins": 11,
+        "impostor_per_cow": np.array([
+            hist(11, {2: 6, 5: 3, 8: 1}),
+            hist(11, {1: 4}),
+            hist(11, {}),
+            hist(11, {10: 2}),
+        ])
+    }
+
+    result = recommend_thresholds(histograms, target_fars=(0.1, 0.0))
+
+    assert result["global"] == [
+        {"target_far": 0.1, "threshold": 0.6, "far": pytest.approx(0.1), "frr": 0.0},
+        {"target_far": 0.0, "threshold": 0.9, "far": 0.0, "frr": 0.25},
+    ]
+    assert (result["genuine_pairs"], result["impostor_pairs"]) == (4, 10)
+    assert result["eer"] == {"threshold": 0.6, "rate": pytest.approx(0.05)}
+    # Seuils par vache bornés par min_threshold / max_threshold, vache sans imposteur absente
+    assert result["per_cow"] == {0: 0.6, 1: 0.5, 3: 0.99}
@@ -0,0 +1,228 @@
+import threading
+
+import numpy as np
+import pytest
+
+from utils.db_sync import VersionedDatabase, DatabaseConflict
+from utils.s3_database import S3DatabaseManager
+from utils.storage import MemoryStorage, StorageObjectExists
+
+
+def embedding(seed):
+    return np.random.default_rng(seed).normal(size=8).astype(np.float32)
+
+
+def make_node(storage, tmp_path, name, mmap_dir=None):
+    """Un nœud de l'API : son gestionnaire et sa base, sur un stockage partagé"""
+    manager = S3DatabaseManager(storage=storage)
+    manager.local_cache = str(tmp_path / f"{name}_cache.json")
+    db = VersionedDatabase(manager, mmap_dir=mmap_dir)
+    db.load()
+    return db
+
+
+@pytest.fixture
+def storage():
+    return MemoryStorage()
+
+
+def test_reload_unchanged(storage, tmp_path):
+    writer = make_node(storage, tmp_path, "writer")
+    writer.add("cow_1", embedding(1))
+    reader = make_node(storage, tmp_path, "reader")
+
+    result = reader.reload()
+
+    assert result["status"] == "unchanged"
+    assert result["version"] == 1
+    assert writer.reload()["status"] == "unchanged"
+
+
+def test_reload_incremental(storage, tmp_path):
+    writer = make_node(storage, tmp_path, "writer")
+    reader = make_node(storage, tmp_path, "reader")
+    writer.add("cow_1", embedding(1))
+    writer.add("cow_2", embedding(2))
+    writer.remove("cow_1")
+
+    result = reader.reload()
+
+    assert result["status"] == "incremental"
+    assert (result["from_version"], result["version"], result["changes_applied"]) == (0, 3, 3)
+    assert reader.store.labels == ["cow_2"]
+    assert reader.etag == writer.etag
+
+
+def test_reload_invalidates_database_info(storage, tmp_path):
+    writer = make_node(storage, tmp_path, "writer")
+    writer.add("cow_1", embedding(1))
+    reader = make_node(storage, tmp_path, "reader")
+    before = reader.manager.get_database_info(use_cache=True)
+    writer.add("cow_2", embedding(2))
+
+    reader.reload()
+
+    after = reader.manager.get_database_info(use_cache=True)
+    assert after == writer.manager.get_database_info()
+    assert after["size"] != before["size"]
+
+
+def test_reload_full_when_database_changed_outside_journal(storage, tmp_path):
+    writer = make_node(storage, tmp_path, "writer")
+    reader = make_node(storage, tmp_path, "reader")
+    writer.add("cow_1", embedding(1))
+    reader.reload()
+
+    # Restauration d'une sauvegarde : nouvel ETag, aucune entrée dans le journal
+    data = writer.store.to_dict()
+    data["labels"].append("cow_restored")
+    data["embeddings"].append(embedding(3).tolist())
+    data["version"] = writer.version
+    writer.manager.save_database(data)
+
+    result = reader.reload()
+
+    assert result["status"] == "full"
+    assert "cow_restored" in reader.store
+    assert reader.reload()["status"] == "unchanged"
+
+
+def test_reload_full_when_journal_has_gap(storage, tmp_path):
+    writer = make_node(storage, tmp_path, "writer")
+    reader = make_node(storage, tmp_path, "reader")
+    writer.add("cow_1", embedding(1))
+    writer.add("cow_2", embedding(2))
+    storage.delete_object(writer.manager._change_key(1))
+
+    result = reader.reload()
+
+    assert result["status"] == "full"
+    assert sorted(reader.store.labels) == ["cow_1", "cow_2"]
+    assert reader.version == 2
+
+
+def test_write_does_not_mutate_served_store(storage, tmp_path):
+    db = make_node(storage, tmp_path, "node")
+    db.add("cow_1", embedding(1))
+    version, served = db.snapshot()
+
+    db.add("cow_2", embedding(2))
+    db.remove("cow_1")
+
+    assert served.labels == ["cow_1"]
+    assert db.store.labels == ["cow_2"]
+    assert db.version == version + 2
+
+
+def test_conflicting_writer_replays_on_top_of_other_node(storage, tmp_path):
+    first = make_node(storage, tmp_path, "first")
+    second = make_node(storage, tmp_path, "second")
+
+    first.add("cow_1", embedding(1))
+    # second n'a pas rechargé : la version 1 est déjà prise dans le journal
+    existed, saved = second.add("cow_2", embedding(2))
+
+    assert (existed, saved) == (False, True)
+    assert second.version == 2
+    assert sorted(second.store.labels) == ["cow_1", "cow_2"]
+    assert storage.list_objects(second.manager.changes_prefix) == [
+        second.manager._change_key(1), second.manager._change_key(2)
+    ]
+    first.reload()
+    assert sorted(first.store.labels) == ["cow_1", "cow_2"]
+
+
+def test_concurrent_writers_keep_every_change(storage, tmp_path):
+    nodes = [make_node(storage, tmp_path, f"node_{i}") for i in range(2)]
+    errors = []
+
+    def enroll(node, n):
+        try:
+            for i in range(10):
+                node.add(f"cow_{n}_{i}", embedding(100 * n + i))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=enroll, args=(node, n)) for n, node in enumerate(nodes)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    expected = sorted(f"cow_{n}_{i}" for n in range(2) for i in range(10))
+    for node in nodes:
+        node.reload()
+        assert sorted(node.store.labels) == expected
+        assert node.version == 20
+    fresh = make_node(storage, tmp_path, "fresh")
+    assert sorted(fresh.store.labels) == expected
+
+
+def test_memory_mapped_after_writes_and_reloads(storage, tmp_path, monkeypatch):
+    writer = make_node(storage, tmp_path, "writer", mmap_dir=str(tmp_path / "writer_mmap"))
+    reader = make_node(storage, tmp_path, "reader", mmap_dir=str(tmp_path / "reader_mmap"))
+
+    writer.add("cow_1", embedding(1))
+    writer.add("cow_2", embedding(2))
+    writer.remove("cow_1")
+    assert writer.store.stats()["memory_mapped"]
+    assert reader.reload()["status"] == "incremental"
+    assert reader.store.stats()["memory_mapped"]
+    assert reader.store.labels == ["cow_2"]
+
+    # Redémarrage : la copie locale correspond à l'ETag distant, le JSON n'est pas relu
+    monkeypatch.setattr(S3DatabaseManager, "load_database", lambda self: pytest.fail("JSON relu"))
+    restarted = make_node(storage, tmp_path, "restarted", mmap_dir=str(tmp_path / "reader_mmap"))
+    assert restarted.version == 3
+    assert restarted.store.labels == ["cow_2"]
+    assert restarted.store.stats()["memory_mapped"]
+    np.testing.assert_allclose(restarted.store.get_embedding("cow_2"), embedding(2), rtol=1e-6)
+
+
+def test_failed_journal_write_publishes_nothing(storage, tmp_path):
+    first = make_node(storage, tmp_path, "first")
+    second = make_node(storage, tmp_path, "second")
+    put_object = storage.put_object
+    failures = []
+
+    def flaky_put(key, body, content_type=None, if_none_match=False):
+        # Le premier put du journal expire sans rien écrire
+        if key.startswith(first.manager.changes_prefix) and not failures:
+            failures.append(key)
+            raise TimeoutError("journal injoignable")
+        return put_object(key, body, content_type=content_type, if_none_match=if_none_match)
+
+    storage.put_object = flaky_put
+    with pytest.raises(TimeoutError):
+        first.add("cow_a", embedding(1))
+
+    assert failures == [first.manager._change_key(1)]
+    assert "cow_a" not in first.store
+    assert first.version == 0
+    assert storage.list_objects(first.manager.changes_prefix) == []
+    assert make_node(storage, tmp_path, "fresh").store.labels == []
+
+    # La version 1 reste libre : l'autre nœud la prend, puis le premier réessaie au-dessus
+    second.add("cow_b", embedding(2))
+    first.add("cow_a", embedding(1))
+    assert sorted(first.store.labels) == ["cow_a", "cow_b"]
+    assert sorted(make_node(storage, tmp_path, "fresh_2").store.labels) == ["cow_a", "cow_b"]
+
+
+def test_conflict_raised_after_retries(storage, tmp_path, monkeypatch):
+    db = make_node(storage, tmp_path, "node")
+    db.commit_retries = 3
+    attempts = []
+
+    def record_change(version, operations):
+        attempts.append(version)
+        raise StorageObjectExists(db.manager._change_key(version))
+
+    monkeypatch.setattr(db.manager, "record_change", record_change)
+
+    with pytest.raises(DatabaseConflict):
+        db.add("cow_1", embedding(1))
+    assert attempts == [1, 1, 1]
+    assert "cow_1" not in db.store
+    assert db.version == 0
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from utils.calibration import normalize_rows
+from utils.dedup import audit_duplicates, find_enrollment_conflicts
+from utils.embedding_store import EmbeddingStore
+
+
+def make_store(n, seed=0, dim=4):
+    """Vaches groupées par trois autour de mêmes centres : beaucoup de paires proches"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n // 3 + 1, dim))
+    store = EmbeddingStore(capacity=4)
+    for i in range(n):
+        store.add(f"c{i}", centers[i // 3] + 0.3 * rng.normal(size=dim))
+    return store
+
+
+def brute_force_pairs(store, threshold):
+    labels = store.labels
+    matrix = normalize_rows([store.get_embedding(label) for label in labels])
+    sims = matrix @ matrix.T
+    pairs = [
+        (float(sims[a, b]), labels[a], labels[b])
+        for a in range(len(labels)) for b in range(a + 1, len(labels))
+        if sims[a, b] >= threshold
+    ]
+    return sorted(pairs, reverse=True)
+
+
+@pytest.mark.parametrize("block_size", [1, 2, 5, 7, 100])
+def test_audit_matches_brute_force(block_size):
+    store = make_store(20)
+    store.remove("c4")
+    expected = brute_force_pairs(store, 0.8)
+    assert len(expected) > 10
+
+    result = audit_duplicates(store, threshold=0.8, block_size=block_size)
+
+    assert result["cows_checked"] == 19
+    assert (result["pairs_found"], result["truncated"]) == (len(expected), False)
+    assert [(p["cow_id_a"], p["cow_id_b"]) for p in result["pairs"]] == [(a, b) for _, a, b in expected]
+    for pair, (similarity, _, _) in zip(result["pairs"], expected):
+        assert pair["similarity"] == pytest.approx(similarity, abs=1e-4)
+
+
+@pytest.mark.parametrize("block_size", [3, 100])
+def test_audit_keeps_most_similar_pairs_when_truncated(block_size):
+    store = make_store(20)
+    expected = brute_force_pairs(store, 0.8)
+
+    result = audit_duplicates(store, threshold=0.8, block_size=block_size, max_pairs=5)
+
+    assert (result["pairs_found"], result["truncated"]) == (len(expected), True)
+    assert [(p["cow_id_a"], p["cow_id_b"]) for p in result["pairs"]] == [(a, b) for _, a, b in expected[:5]]
+
+
+def test_enrollment_conflicts_exclude_enrolling_cow():
+    store = make_store(9)
+    emb = store.get_embedding("c0")
+    queries = [emb, emb + 0.01, store.get_embedding("c8")]
+
+    conflicts = find_enrollment_conflicts(store, queries, cow_id="c0", threshold=0.99)
+
+    labels = [c["cow_id"] for c in conflicts]
+    assert "c0" not in labels and "c8" in labels
+    c8 = conflicts[labels.index("c8")]
+    assert c8["max_image_similarity"] == pytest.approx(1.0, abs=1e-4)
+    assert c8["images_above_threshold"] == 1
+    assert find_enrollment_conflicts(EmbeddingStore(), queries) == []
@@ -0,0 +1,162 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from utils.embedding_store import EmbeddingStore, MEMMAP_INDEX_FILE, MEMMAP_MATRIX_PREFIX, COMPACTION_RATIO
+
+
+def embedding(seed, dim=8):
+    return np.random.default_rng(seed).normal(size=dim).astype(np.float32)
+
+
+def make_store(labels):
+    store = EmbeddingStore(capacity=2)
+    for i, label in enumerate(labels):
+        store.add(label, embedding(i), {"images_count": i})
+    return store
+
+
+def test_add_grows_capacity():
+    store = make_store([f"c{i}" for i in range(5)])
+
+    stats = store.stats()
+    assert (stats["active_cows"], stats["rows"], stats["capacity"]) == (5, 5, 8)
+    for i in range(5):
+        np.testing.assert_array_equal(store.get_embedding(f"c{i}"), embedding(i))
+
+
+def test_remove_leaves_tombstone():
+    store = make_store([f"c{i}" for i in range(8)])
+
+    assert store.remove("c3")
+    assert not store.remove("c3")
+    assert not store.remove("unknown")
+
+    stats = store.stats()
+    assert (stats["active_cows"], stats["rows"], stats["tombstones"]) == (7, 8, 1)
+    assert "c3" not in store
+    assert store.get_embedding("c3") is None and store.get_metadata("c3") is None
+    assert store.similarities(embedding(3))[3] == -np.inf
+    assert store.best_match(embedding(3))[0] != "c3"
+    labels, sims = store.similarities_batch([embedding(3), embedding(4)])
+    assert labels == store.labels and "c3" not in labels
+    assert sims.shape == (2, 7)
+    assert sims[1, labels.index("c4")] == pytest.approx(1.0)
+
+
+def test_compaction_past_ratio():
+    labels = [f"c{i}" for i in range(8)]
+    store = make_store(labels)
+    # Jusqu'à COMPACTION_RATIO * lignes tombstones, la matrice garde ses lignes mortes
+    tolerated = int(COMPACTION_RATIO * len(labels))
+    removed = labels[1:2 * tolerated + 2:2]
+    for label in removed[:-1]:
+        store.remove(label)
+    assert store.stats()["rows"] == len(labels)
+
+    store.remove(removed[-1])
+
+    stats = store.stats()
+    assert (stats["rows"], stats["tombstones"]) == (len(labels) - len(removed), 0)
+    kept = [label for label in labels if label not in removed]
+    assert store.labels == kept
+    for label in kept:
+        i = labels.index(label)
+        np.testing.assert_array_equal(store.get_embedding(label), embedding(i))
+        assert store.best_match(embedding(i)) == (label, pytest.approx(1.0))
+
+
+def test_re_add_after_tombstone():
+    store = make_store(["a", "b", "c", "d", "e"])
+    store.remove("b")
+
+    assert not store.add("b", embedding(10), {"images_count": 10})
+
+    assert store.labels == ["a", "c", "d", "e", "b"]
+    assert store.stats()["tombstones"] == 1
+    np.testing.assert_array_equal(store.get_embedding("b"), embedding(10))
+    assert store.get_metadata("b")["images_count"] == 10
+    assert store.best_match(embedding(10)) == ("b", pytest.approx(1.0))
+    assert store.best_match(embedding(1))[1] < 0.99
+
+
+def test_page_offsets():
+    store = make_store([f"c{i}" for i in range(6)])
+    store.remove("c1")
+
+    first = store.page(offset=0, limit=2)
+    second = store.page(offset=2, limit=2)
+    last = store.page(offset=4, limit=2)
+
+    assert [(row["cow_id"], row["index"]) for row in first + second + last] == [
+        ("c0", 0), ("c2", 1), ("c3", 2), ("c4", 3), ("c5", 4)
+    ]
+    assert second[0]["images_count"] == 3
+    assert store.page(offset=10, limit=2) == []
+
+
+def test_memmap_round_trip(tmp_path):
+    store = make_store(["a", "b", "c"])
+    store.remove("b")
+
+    index = store.save_memmap(str(tmp_path), version=3, etag="e3")
+    mapped, loaded = EmbeddingStore.load_memmap(str(tmp_path))
+
+    assert loaded == index
+    assert loaded["matrix"].startswith(MEMMAP_MATRIX_PREFIX + "3-")
+    assert mapped.labels == ["a", "c"]
+    assert mapped.stats()["memory_mapped"]
+    np.testing.assert_array_equal(mapped.get_embedding("c"), embedding(2))
+    assert mapped.get_metadata("c")["images_count"] == 2
+
+
+def test_concurrent_memmap_writers_never_mix_matrices(tmp_path):
+    directory = str(tmp_path)
+    stores = [make_store([f"w{w}_{i}" for i in range(4)]) for w in range(4)]
+    written = []
+    errors = []
+
+    def write(worker, store):
+        try:
+            for version in range(10):
+                index = store.save_memmap(directory, version=version, etag=f"{worker}-{version}")
+                written.append((store, EmbeddingStore.load_memmap(directory, index)[0]))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(w, store)) for w, store in enumerate(stores)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    # Chaque écrivain rouvre sa propre matrice, quel que soit l'index courant du dossier
+    for store, mapped in written:
+        assert mapped.labels == store.labels
+        for label in store.labels:
+            np.testing.assert_array_equal(mapped.get_embedding(label), store.get_embedding(label))
+    # L'index courant décrit toujours la matrice qu'il désigne
+    current, index = EmbeddingStore.load_memmap(directory)
+    assert os.path.exists(os.path.join(directory, index["matrix"]))
+    assert not [name for name in os.listdir(directory) if ".tmp-" in name]
+    assert MEMMAP_INDEX_FILE in os.listdir(directory)
+
+
+def test_stale_matrices_removed_after_grace_period(tmp_path):
+    directory = str(tmp_path)
+    store = make_store(["a", "b"])
+    first = store.save_memmap(directory, version=1)
+    second = store.save_memmap(directory, version=2)
+    # Encore récente : gardée pour un lecteur qui viendrait de lire l'index précédent
+    assert os.path.exists(os.path.join(directory, first["matrix"]))
+
+    old = os.path.join(directory, first["matrix"])
+    os.utime(old, (0, 0))
+    third = store.save_memmap(directory, version=3)
+
+    assert not os.path.exists(old)
+    assert os.path.exists(os.path.join(directory, second["matrix"]))
+    assert os.path.exists(os.path.join(directory, third["matrix"]))
@@ -1,64 +1,39 @@
-import boto3
-import cv2
 import os
-from io import BytesIO
-from botocore.exceptions import ClientError
 import logging
 from dotenv import load_dotenv
+from utils.storage import get_storage, StorageObjectNotFound
 
 logger = logging.getLogger(__name__)
 
 class S3Manager:
-    def __init__(self, bucket_name=None, region_name=None):
+    def __init__(self, bucket_name=None, region_name=None, storage=None):
         """
-        Initialise le gestionnaire S3
+        Initialise le gestionnaire des images (S3, dossier local ou mémoire selon STORAGE_BACKEND)
         
         Args:
             bucket_name: Nom du bucket S3 (peut être défini via variable d'environnement AWS_S3_BUCKET)
             region_name: Région AWS (défaut: depuis env)
+            storage: Backend de stockage (défaut: backend partagé de l'application)
         """
         # Forcer le rechargement des variables d'environnement
         load_dotenv(override=True)
         
-        self.bucket_name = bucket_name or os.getenv('AWS_S3_BUCKET', 'cow-muzzle-images')
+        self.storage = storage or get_storage()
+        self.bucket_name = bucket_name or self.storage.bucket_name
         self.region_name = region_name or os.getenv('AWS_REGION', 'us-east-1')
-        
-        # Initialisation du client S3 avec session explicite
-        try:
-            session = boto3.Session(
-                aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-                aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-                region_name=self.region_name
-            )
-            self.s3_client = session.client('s3')
-            logger.info(f"S3Manager initialisé - Bucket: {self.bucket_name}, Région: {self.region_name}")
-        except Exception as e:
-            logger.error(f"Erreur lors de l'initialisation du client S3: {e}")
-            raise
+        logger.info(f"S3Manager initialisé - Backend: {self.storage.backend_name}, Bucket: {self.bucket_name}")
     
     def create_bucket_if_not_exists(self):
         """Crée le bucket S3 s'il n'existe pas"""
-        try:
-            self.s3_client.head_bucket(Bucket=self.bucket_name)
-            logger.info(f"Le bucket {self.bucket_name} existe déjà")
-        except ClientError as e:
-            error_code = int(e.response['Error']['Code'])
-            if error_code == 404:
-                try:
-                    if self.region_name == 'us-east-1':
-                        self.s3_client.create_bucket(Bucket=self.bucket_name)
-                    else:
-                        self.s3_client.create_bucket(
-                            Bucket=self.bucket_name,
-                            CreateBucketConfiguration={'LocationConstraint': self.region_name}
-                        )
-                    logger.info(f"Bucket {self.bucket_name} créé avec succès")
-                except ClientError as create_error:
-                    logger.error(f"Erreur lors de la création du bucket: {create_error}")
-                    raise
-            else:
-                logger.error(f"Erreur lors de la vérification du bucket: {e}")
-                raise
+        self.storage.ensure_bucket()
+    
+    def check_access(self):
+        """Vérifie l'accès au stockage (lève une exception sinon)"""
+        self.storage.check_access()
+    
+    def image_url(self, key):
+        """URL publique d'une image"""
+        return self.storage.public_url(key)
     
     def list_cow_raw_images(self, cow_id):
         """
@@ -72,26 +47,38 @@ class S3Manager:
         """
         try:
             prefix = f"{cow_id}/"
-            response = self.s3_client.list_objects_v2(
-                Bucket=self.bucket_name,
-                Prefix=prefix
-            )
-            
-            image_keys = []
-            if 'Contents' in response:
-                for obj in response['Contents']:
-                    # Filtrer pour ne garder que les fichiers image
-                    key = obj['Key']
-                    if key.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp', '.tiff')):
-                        image_keys.append(key)
+            # Filtrer pour ne garder que les fichiers image
+            image_keys = [
+                key for key in self.storage.list_objects(prefix)
+                if key.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp', '.tiff'))
+            ]
             
             logger.info(f"Trouvé {len(image_keys)} images pour la vache {cow_id}")
             return image_keys
             
-        except ClientError as e:
+        except Exception as e:
             logger.error(f"Erreur lors de la liste des images brutes: {e}")
             return []
     
+    def get_image_bytes(self, s3_key):
+        """
+        Lit une image directement en mémoire
+        
+        Args:
+            s3_key: Clé S3 de l'image
+            
+        Returns:
+            bytes: Contenu de l'image, None en cas d'échec
+        """
+        try:
+            return self.storage.get_object(s3_key)
+        except StorageObjectNotFound:
+            logger.error(f"Image introuvable: {s3_key}")
+            return None
+        except Exception as e:
+            logger.error(f"Erreur lors de la lecture de {s3_key}: {e}")
+            return None
+    
     def download_image(self, s3_key, local_path):
         """
         Télécharge une image depuis S3 vers un fichier local
@@ -103,14 +90,14 @@ class S3Manager:
         Returns:
             bool: True si succès, False sinon
         """
+        data = self.get_image_bytes(s3_key)
+        if data is None:
+            return False
         try:
-            self.s3_client.download_file(self.bucket_name, s3_key, local_path)
+            with open(local_path, 'wb') as f:
+                f.write(data)
             logger.info(f"Image téléchargée: {s3_key} -> {local_path}")
             return True
-            
-        except ClientError as e:
-            logger.error(f"Erreur lors du téléchargement de {s3_key}: {e}")
-            return False
         except Exception as e:
             logger.error(f"Erreur inattendue lors du téléchargement: {e}")
-            return False
\ No newline at end of file
+            return False
@@ -0,0 +1,175 @@
+import numpy as np
+
+# Les similarités sont histogrammées sur [0, 1] (les scores négatifs tombent dans le premier bin)
+DEFAULT_BINS = 1001
+# Histogrammes par vache plus grossiers (pas de 0.01) : N vaches x bins compteurs, deux fois
+DEFAULT_PER_COW_BINS = 101
+
+
+def normalize_rows(x):
+    """Normalise chaque ligne (norme L2) pour que le produit matriciel donne la similarité cosinus"""
+    x = np.asarray(x, dtype=np.float32)
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    return x / np.maximum(norms, 1e-12)
+
+
+def _bin_index(sims, bins):
+    return np.clip(np.rint(sims * (bins - 1)), 0, bins - 1).astype(np.int64)
+
+
+def bin_edges(bins=DEFAULT_BINS):
+    """Score associé à chaque bin"""
+    return np.linspace(0.0, 1.0, bins)
+
+
+def similarity_histograms(queries, query_labels, gallery, gallery_labels,
+                          block_size=1024, bins=DEFAULT_BINS, per_cow=False, exclude_self=False,
+                          per_cow_bins=DEFAULT_PER_COW_BINS):
+    """
+    Distributions des similarités authentiques / imposteurs entre des requêtes et la galerie
+
+    Le produit requêtes x galerie est calculé par blocs (block_size x block_size) et
+    seuls des histogrammes sont accumulés : la mémoire reste en O(block_size² + bins)
+    (O(nombre de vaches x per_cow_bins) avec per_cow, compteurs int32), jamais en O(N²).
+
+    Args:
+        queries: Embeddings des crops de test (Q x D)
+        query_labels: Label de chaque requête (absent de la galerie = imposteur partout)
+        gallery: Embeddings de la base (N x D)
+        gallery_labels: Labels de la base
+        block_size: Taille des blocs du produit matriciel
+        bins: Nombre de bins sur [0, 1]
+        per_cow: Accumuler aussi les histogrammes par vache de la galerie (colonne)
+        exclude_self: Ignorer la diagonale (galerie comparée à elle-même)
+        per_cow_bins: Nombre de bins des histogrammes par vache
+
+    Returns:
+        dict: genuine, impostor (histogrammes globaux) et, avec per_cow,
+              genuine_per_cow / impostor_per_cow (N x per_cow_bins, int32)
+    """
+    queries = normalize_rows(queries)
+    gallery = normalize_rows(gallery)
+    label_ids = {label: i for i, label in enumerate(gallery_labels)}
+    query_ids = np.array([label_ids.get(label, -1) for label in query_labels], dtype=np.int64)
+    gallery_ids = np.arange(len(gallery_labels), dtype=np.int64)
+    n_gallery = gallery.shape[0]
+
+    genuine = np.zeros(bins, dtype=np.int64)
+    impostor = np.zeros(bins, dtype=np.int64)
+    if per_cow:
+        genuine_per_cow = np.zeros((n_gallery, per_cow_bins), dtype=np.int32)
+        impostor_per_cow = np.zeros((n_gallery, per_cow_bins), dtype=np.int32)
+
+    for q_start in range(0, queries.shape[0], block_size):
+        q_block = queries[q_start:q_start + block_size]
+        q_ids = query_ids[q_start:q_start + block_size]
+        for g_start in range(0, n_gallery, block_size):
+            g_block = gallery[g_start:g_start + block_size]
+            g_ids = gallery_ids[g_start:g_start + block_size]
+
+            sims = q_block @ g_block.T
+            idx = _bin_index(sims, bins)
+            is_genuine = q_ids[:, None] == g_ids[None, :]
+            valid = np.ones_like(is_genuine)
+            if exclude_self:
+                rows = np.arange(q_start, q_start + q_block.shape[0])[:, None]
+                cols = np.arange(g_start, g_start + g_block.shape[0])[None, :]
+                valid = rows != cols
+
+            genuine += np.bincount(idx[is_genuine & valid], minlength=bins)
+            impostor += np.bincount(idx[~is_genuine & valid], minlength=bins)
+
+            if per_cow:
+                # Index (colonne, bin) aplati pour un seul bincount par bloc
+                cow_idx = idx if per_cow_bins == bins else _bin_index(sims, per_cow_bins)
+                flat = (np.arange(g_block.shape[0])[None, :] * per_cow_bins + cow_idx)
+                size = g_block.shape[0] * per_cow_bins
+                g_slice = slice(g_start, g_start + g_block.shape[0])
+                genuine_per_cow[g_slice] += np.bincount(flat[is_genuine & valid], minlength=size).reshape(-1, per_cow_bins).astype(np.int32)
+                impostor_per_cow[g_slice] += np.bincount(flat[~is_genuine & valid], minlength=size).reshape(-1, per_cow_bins).astype(np.int32)
+
+    result = {"genuine": genuine, "impostor": impostor, "bins": bins}
+    if per_cow:
+        result["genuine_per_cow"] = genuine_per_cow
+        result["impostor_per_cow"] = impostor_per_cow
+    return result
+
+
+def false_accept_rates(impostor_hist):
+    """FAR(t) pour chaque seuil t = bin : proportion d'imposteurs avec un score >= t"""
+    total = impostor_hist.sum()
+    if total == 0:
+        return np.zeros(len(impostor_hist))
+    return np.cumsum(impostor_hist[::-1])[::-1] / total
+
+
+def false_reject_rates(genuine_hist):
+    """FRR(t) pour chaque seuil t = bin : proportion d'authentiques avec un score < t"""
+    total = genuine_hist.sum()
+    if total == 0:
+        return np.zeros(len(genuine_hist))
+    return np.concatenate([[0], np.cumsum(genuine_hist)[:-1]]) / total
+
+
+def threshold_for_far(impostor_hist, target_far):
+    """
+    Plus petit seuil dont le taux de fausses acceptations ne dépasse pas target_far
+
+    Returns:
+        float: Seuil, None s'il n'y a aucun score imposteur
+    """
+    if impostor_hist.sum() == 0:
+        return None
+    far = false_accept_rates(impostor_hist)
+    candidates = np.flatnonzero(far <= target_far)
+    bins = len(impostor_hist)
+    # Au-delà du dernier bin : aucun seuil atteignable, on retourne 1.0
+    return float(bin_edges(bins)[candidates[0]]) if len(candidates) else 1.0
+
+
+def recommend_thresholds(histograms, target_fars=(0.01, 0.001), min_threshold=0.5, max_threshold=0.99):
+    """
+    Seuils recommandés pour chaque taux de fausses acceptations visé
+
+    Returns:
+        dict: {"global": [{"target_far", "threshold", "far", "frr"}], "eer": {...},
+               "per_cow": {index_vache: seuil} (pour le premier target_far, si disponibles)}
+    """
+    genuine, impostor, bins = histograms["genuine"], histograms["impostor"], histograms["bins"]
+    edges = bin_edges(bins)
+    far = false_accept_rates(impostor)
+    frr = false_reject_rates(genuine)
+
+    recommendations = []
+    for target in target_fars:
+        threshold = threshold_for_far(impostor, target)
+        if threshold is None:
+            recommendations.append({"target_far": target, "threshold": None})
+            continue
+        i = int(np.rint(threshold * (bins - 1)))
+        recommendations.append({
+            "target_far": target,
+            "threshold": round(threshold, 4),
+            "far": float(far[i]),
+            "frr": float(frr[i]) if genuine.sum() else None
+        })
+
+    result = {
+        "global": recommendations,
+        "genuine_pairs": int(genuine.sum()),
+        "impostor_pairs": int(impostor.sum())
+    }
+
+    if genuine.sum() and impostor.sum():
+        i = int(np.argmin(np.abs(far - frr)))
+        result["eer"] = {"threshold": round(float(edges[i]), 4), "rate": float((far[i] + frr[i]) / 2)}
+
+    if "impostor_per_cow" in histograms and target_fars:
+        per_cow = {}
+        for row, hist in enumerate(histograms["impostor_per_cow"]):
+            threshold = threshold_for_far(hist, target_fars[0])
+            if threshold is not None:
+                per_cow[row] = round(min(max(threshold, min_threshold), max_threshold), 4)
+        result["per_cow"] = per_cow
+
+    return result
@@ -0,0 +1,369 @@
+import os
+import threading
+from datetime import datetime, timezone
+import logging
+from utils.embedding_store import EmbeddingStore
+from utils.s3_database import db_manager
+from utils.storage import StorageObjectExists
+
+logger = logging.getLogger(__name__)
+
+
+class DatabaseConflict(Exception):
+    """Levée quand une écriture perd DB_COMMIT_RETRIES fois de suite la course avec un autre nœud"""
+
+
+class VersionedDatabase:
+    """
+    Base d'embeddings versionnée, partagée entre plusieurs nœuds via S3
+
+    - Chaque modification locale incrémente la version et est écrite dans le
+      journal (database/changes/) avant la base complète
+    - reload() compare d'abord l'ETag S3 (HEAD) : rien n'est téléchargé si la
+      base n'a pas changé ; sinon seules les entrées du journal postérieures à
+      la version chargée sont appliquées (rechargement complet si le journal
+      est incomplet ou si la base a changé hors du journal)
+    - Chaque écriture réserve sa version en créant l'entrée du journal de façon
+      conditionnelle : si un autre nœud l'a déjà prise, la base est mise à jour
+      depuis le journal et l'écriture rejouée
+    - La nouvelle version est construite sur une copie puis échangée en une
+      seule affectation : une requête /predict en cours garde la version
+      qu'elle a lue
+    - Avec mmap_dir (EMBEDDINGS_MMAP_DIR), chaque nouvelle version (chargement,
+      rechargement, écriture) est aussi écrite sur le disque local et servie mappée
+      en mémoire ; au démarrage suivant, si l'ETag distant n'a pas changé, le JSON
+      n'est même pas téléchargé
+    """
+
+    def __init__(self, manager=None, mmap_dir=None):
+        self.manager = manager or db_manager
+        self.mmap_dir = mmap_dir if mmap_dir is not None else os.getenv('EMBEDDINGS_MMAP_DIR') or None
+        self.store = EmbeddingStore()
+        self.version = 0
+        self.etag = None
+        self.last_modified = None
+        self.loaded_at = None
+        self.commit_retries = max(1, int(os.getenv('DB_COMMIT_RETRIES', '5')))
+        self._write_lock = threading.Lock()
+        self._mmap_lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._listeners = []
+        self._poller = None
+        self._stop_polling = threading.Event()
+
+    def snapshot(self):
+        """
+        (version, base) cohérents pour une requête
+
+        La version est lue avant la base : au pire un résultat calculé sur une base
+        plus récente est associé à l'ancienne version, jamais l'inverse.
+        """
+        version = self.version
+        return version, self.store
+
+    def add_listener(self, callback):
+        """Enregistre callback(result) appelé après chaque changement de la base (écriture ou rechargement)"""
+        self._listeners.append(callback)
+
+    def _notify(self, result):
+        for callback in self._listeners:
+            try:
+                callback(result)
+            except Exception as e:
+                logger.error(f"Erreur dans un listener de la base: {e}")
+
+    def _set_remote(self, remote):
+        etag = remote["etag"] if remote else None
+        if etag != self.etag:
+            # Nouvelle version distante : /database/info ne doit plus servir l'ancienne
+            self.manager.invalidate_info_cache()
+        self.etag = etag
+        self.last_modified = remote["last_modified"] if remote else None
+        self.loaded_at = datetime.now(timezone.utc)
+
+    def load(self):
+        """Chargement complet depuis S3"""
+        with self._reload_lock:
+            result = self._full_reload()
+        self._notify(result)
+        return result
+
+    def _load_store(self, remote):
+        """
+        Base complète : copie locale mappée en mémoire si elle correspond à l'ETag distant, sinon S3
+
+        Returns:
+            tuple: (base, version)
+        """
+        if self.mmap_dir and remote is not None:
+            try:
+                store, index = EmbeddingStore.load_memmap(self.mmap_dir)
+                if index.get("etag") == remote["etag"]:
+                    logger.info(f"Base de données ouverte depuis la copie locale {self.mmap_dir}")
+                    return store, index.get("version", 0)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.warning(f"Copie locale de la base illisible, rechargement depuis S3: {e}")
+
+        data = self.manager.load_database()
+        store = EmbeddingStore.from_dict(data)
+        version = data.get("version", 0)
+        return self._remap(store, version, remote["etag"] if remote else None), version
+
+    def _remap(self, store, version, etag):
+        """
+        Avec mmap_dir : écrit la base sur le disque local et la rouvre mappée en mémoire
+
+        Une copie ou un ajout ramène la matrice en mémoire : chaque nouvelle version est
+        réécrite pour que la base servie reste adossée au fichier (sinon store est retournée).
+        """
+        if not self.mmap_dir:
+            return store
+        try:
+            # Sérialisé entre écritures et rechargements ; l'index retourné désigne notre
+            # matrice même si un autre processus remplace l'index du dossier entre-temps
+            with self._mmap_lock:
+                index = store.save_memmap(self.mmap_dir, version=version, etag=etag)
+                mapped, _ = EmbeddingStore.load_memmap(self.mmap_dir, index)
+        except Exception as e:
+            logger.warning(f"Impossible d'écrire la copie locale de la base: {e}")
+            return store
+        # Les doublons signalés au chargement du JSON restent visibles dans les statistiques
+        mapped.duplicate_labels = store.duplicate_labels
+        return mapped
+
+    def _full_reload(self):
+        started_version = self.version
+        remote = self.manager.get_remote_version()
+        store, version = self._load_store(remote)
+        # La base complète peut être en retard sur le journal (deux écritures terminées dans le désordre)
+        changes = self.manager.load_changes(version) or []
+        for change_version, operations in changes:
+            store.apply_operations(operations)
+            version = change_version
+        if changes:
+            store = self._remap(store, version, remote["etag"] if remote else None)
+        with self._write_lock:
+            if self.version != started_version:
+                # Une écriture locale a eu lieu pendant le téléchargement : garder l'état local
+                logger.info("Rechargement ignoré: écriture locale concurrente")
+                return {"status": "skipped", "version": self.version, "changes_applied": 0}
+            self.store = store
+            self.version = version
+            self._set_remote(remote)
+        logger.info(f"Base de données chargée (version {self.version}, {len(store)} vaches)")
+        return {"status": "full", "version": self.version, "changes_applied": len(store)}
+
+    def _apply_changes(self, changes, remote=None):
+        """
+        Applique des entrées du journal sur une copie de la base puis l'échange
+
+        Args:
+            remote: Version distante à mémoriser (None : garder l'ETag connu)
+        """
+        with self._write_lock:
+            from_version = new_version = self.version
+            store = self.store.copy()
+            applied = 0
+            for version, operations in changes:
+                # Une écriture locale a pu réserver des versions depuis la lecture du journal
+                if version <= new_version:
+                    continue
+                store.apply_operations(operations)
+                applied += len(operations)
+                new_version = version
+            if remote is not None:
+                self._set_remote(remote)
+            store = self._remap(store, new_version, remote["etag"] if remote else None)
+            # Échange atomique de la version en service
+            self.store = store
+            self.version = new_version
+        logger.info(f"Base de données mise à jour: version {from_version} -> {self.version} ({applied} opérations)")
+        return {"status": "incremental", "version": self.version, "changes_applied": applied}
+
+    def reload(self, force=False):
+        """
+        Recharge la base si elle a changé sur S3
+
+        Args:
+            force: Ignorer l'ETag et le journal, toujours tout recharger
+
+        Returns:
+            dict: {"status": "unchanged"|"incremental"|"full"|"skipped", "from_version", "version", "changes_applied"}
+        """
+        with self._reload_lock:
+            from_version = self.version
+            if force:
+                result = self._full_reload()
+            else:
+                remote = self.manager.get_remote_version()
+                if remote is not None and remote["etag"] == self.etag:
+                    return {"status": "unchanged", "from_version": from_version, "version": from_version, "changes_applied": 0}
+
+                changes = self.manager.load_changes(from_version)
+                if not changes:
+                    # Journal incomplet, ou base modifiée sans entrée dans le journal (restauration...)
+                    logger.info("Base modifiée hors du journal ou journal incomplet, rechargement complet")
+                    result = self._full_reload()
+                else:
+                    result = self._apply_changes(changes, remote)
+            result["from_version"] = from_version
+        if result["status"] != "skipped":
+            self._notify(result)
+        return result
+
+    def _catch_up(self):
+        """Applique le journal écrit par les autres nœuds (après un conflit d'écriture)"""
+        with self._reload_lock:
+            from_version = self.version
+            changes = self.manager.load_changes(from_version)
+            if changes is None:
+                result = self._full_reload()
+            elif changes:
+                result = self._apply_changes(changes)
+            else:
+                return
+            result["from_version"] = from_version
+        if result["status"] != "skipped":
+            self._notify(result)
+
+    def _write(self, apply):
+        """
+        Modifie une copie de la base, la publie puis l'échange avec la version en service
+
+        apply(base) modifie la copie et retourne (opérations, résultat) ; sans opération
+        rien n'est écrit. La version suivante est réservée par la création conditionnelle
+        de son entrée du journal : si un autre nœud l'a déjà écrite, le journal est
+        appliqué et la modification rejouée, au plus DB_COMMIT_RETRIES fois. Si l'entrée
+        ne peut pas être écrite (stockage injoignable...), l'erreur est propagée et la
+        base en service reste inchangée.
+
+        Returns:
+            tuple: (résultat, sauvegarde_réussie) - lève DatabaseConflict si toutes les tentatives échouent
+        """
+        for attempt in range(1, self.commit_retries + 1):
+            with self._write_lock:
+                store = self.store.copy()
+                operations, result = apply(store)
+                if not operations:
+                    return result, False
+                version = self.version + 1
+                try:
+                    self.manager.record_change(version, operations)
+                except StorageObjectExists:
+                    pass
+                else:
+                    self.store = store
+                    self.version = version
+                    data = store.to_dict()
+                    data["version"] = version
+                    saved = self.manager.save_database(data)
+                    # Mémoriser l'ETag de notre propre écriture pour ne pas la recharger, sauf si
+                    # un autre nœud a déjà écrit la version suivante : l'ETag lu peut être le sien
+                    # (son entrée du journal est toujours écrite avant sa base)
+                    etag = None
+                    if saved:
+                        remote = self.manager.get_remote_version()
+                        if not self.manager.change_exists(version + 1):
+                            self._set_remote(remote)
+                            etag = self.etag
+                    # Même contenu, adossé au fichier local (sans ETag si la base distante n'est pas la nôtre)
+                    self.store = self._remap(store, version, etag)
+                    break
+            logger.warning(f"Conflit d'écriture sur la version {version} (tentative {attempt}/{self.commit_retries})")
+            self._catch_up()
+        else:
+            raise DatabaseConflict(f"Version {version} écrite par un autre nœud, abandon après {self.commit_retries} tentatives")
+        self._notify({"status": "local", "version": version, "changes_applied": len(operations)})
+        return result, saved
+
+    def add(self, label, embedding, metadata=None):
+        """
+        Ajoute (ou remplace) une vache et sauvegarde la base
+
+        Returns:
+            tuple: (existait_déjà, sauvegarde_réussie)
+        """
+        def apply(store):
+            existed = store.add(label, embedding, metadata)
+            operation = {
+                "op": "add",
+                "label": label,
+                "embedding": store.get_embedding(label).tolist(),
+                "metadata": store.get_metadata(label)
+            }
+            return [operation], existed
+
+        return self._write(apply)
+
+    def remove(self, label):
+        """
+        Supprime une vache et sauvegarde la base
+
+        Returns:
+            tuple: (supprimée, sauvegarde_réussie)
+        """
+        def apply(store):
+            if not store.remove(label):
+                return [], False
+            return [{"op": "remove", "label": label}], True
+
+        return self._write(apply)
+
+    def set_calibration(self, thresholds, calibration):
+        """
+        Enregistre le résultat d'une calibration (seuils par vache et seuil global) et sauvegarde la base
+
+        Args:
+            thresholds: {label: seuil} (peut être vide)
+            calibration: {"threshold", "target_far", ...} ou None
+        """
+        operation = {"op": "calibrate", "thresholds": thresholds, "calibration": calibration}
+
+        def apply(store):
+            store.apply_operations([operation])
+            return [operation], None
+
+        _, saved = self._write(apply)
+        return saved
+
+    def start_polling(self, interval=None):
+        """
+        Démarre un thread qui appelle reload() périodiquement (DB_POLL_INTERVAL secondes, 0 = désactivé)
+
+        Returns:
+            bool: True si le polling a été démarré
+        """
+        interval = float(interval if interval is not None else os.getenv('DB_POLL_INTERVAL', '0'))
+        if interval <= 0 or self._poller is not None:
+            return False
+        self._stop_polling.clear()
+
+        def poll():
+            while not self._stop_polling.wait(interval):
+                try:
+                    self.reload()
+                except Exception as e:
+                    logger.error(f"Erreur lors du polling de la base: {e}")
+
+        self._poller = threading.Thread(target=poll, name="db-poller", daemon=True)
+        self._poller.start()
+        logger.info(f"Polling de la base de données toutes les {interval}s")
+        return True
+
+    def stop_polling(self):
+        self._stop_polling.set()
+        if self._poller is not None:
+            self._poller.join(timeout=5)
+            self._poller = None
+
+    def info(self):
+        return {
+            "version": self.version,
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "loaded_at": self.loaded_at,
+            "polling": self._poller is not None,
+            "mmap_dir": self.mmap_dir
+        }
@@ -0,0 +1,104 @@
+import os
+import heapq
+import numpy as np
+
+
+def duplicate_threshold():
+    """Similarité au-delà de laquelle deux vaches sont considérées comme un même animal probable"""
+    return float(os.getenv('DUPLICATE_SIMILARITY_THRESHOLD', '0.95'))
+
+
+def find_enrollment_conflicts(store, embeddings, cow_id=None, threshold=None, top_k=5):
+    """
+    Cherche si les embeddings d'un enrôlement correspondent à des vaches déjà enregistrées
+
+    Tous les embeddings (moyenne + un par image) sont comparés à la base en un seul
+    produit matriciel.
+
+    Args:
+        store: EmbeddingStore
+        embeddings: Embeddings à comparer (le premier est la moyenne, les suivants les images)
+        cow_id: Vache en cours d'enrôlement (exclue des conflits)
+        threshold: Similarité minimale pour signaler un conflit (défaut: DUPLICATE_SIMILARITY_THRESHOLD)
+        top_k: Nombre maximal de conflits retournés
+
+    Returns:
+        list: [{"cow_id", "similarity" (avec la moyenne), "max_image_similarity", "images_above_threshold"}]
+              triée par similarité décroissante
+    """
+    if threshold is None:
+        threshold = duplicate_threshold()
+    if len(embeddings) == 0:
+        return []
+    # Labels et similarités lus ensemble : les colonnes correspondent toujours aux labels
+    labels, sims = store.similarities_batch(embeddings)
+    if len(labels) == 0:
+        return []
+    avg_sims = sims[0]
+    image_sims = sims[1:] if sims.shape[0] > 1 else sims
+
+    best_per_row = np.maximum(avg_sims, image_sims.max(axis=0))
+    candidates = np.flatnonzero(best_per_row >= threshold)
+    conflicts = []
+    for row in candidates:
+        label = labels[row]
+        if label == cow_id:
+            continue
+        conflicts.append({
+            "cow_id": label,
+            "similarity": round(float(avg_sims[row]), 4),
+            "max_image_similarity": round(float(image_sims[:, row].max()), 4),
+            "images_above_threshold": int((image_sims[:, row] >= threshold).sum())
+        })
+    conflicts.sort(key=lambda c: max(c["similarity"], c["max_image_similarity"]), reverse=True)
+    return conflicts[:top_k]
+
+
+def audit_duplicates(store, threshold=None, block_size=1024, max_pairs=10000):
+    """
+    Toutes les paires de vaches quasi identiques dans la base
+
+    Produit matriciel par blocs sur le triangle supérieur uniquement : mémoire en
+    O(block_size² + max_pairs), jamais O(N²). Seules les max_pairs paires les plus
+    similaires sont gardées (tas borné), quel que soit l'ordre de parcours.
+
+    Returns:
+        dict: {"pairs": [{"cow_id_a", "cow_id_b", "similarity"}], "pairs_found", "truncated", "cows_checked"}
+    """
+    if threshold is None:
+        threshold = duplicate_threshold()
+    labels, matrix = store.active_rows()
+    n = len(labels)
+    heap = []  # (similarité, ligne a, ligne b), la plus faible en tête
+    total_found = 0
+    for a_start in range(0, n, block_size):
+        a_block = matrix[a_start:a_start + block_size]
+        for b_start in range(a_start, n, block_size):
+            b_block = matrix[b_start:b_start + block_size]
+            sims = a_block @ b_block.T
+            if a_start == b_start:
+                # Même bloc : garder seulement i < j
+                sims[np.tril_indices_from(sims)] = -np.inf
+            rows, cols = np.nonzero(sims >= threshold)
+            total_found += len(rows)
+            if len(heap) >= max_pairs:
+                # Tas plein : seules les paires plus similaires que la plus faible gardée peuvent entrer
+                keep = sims[rows, cols] > heap[0][0]
+                rows, cols = rows[keep], cols[keep]
+            for i, j in zip(rows, cols):
+                item = (float(sims[i, j]), a_start + int(i), b_start + int(j))
+                if len(heap) < max_pairs:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    heapq.heapreplace(heap, item)
+    pairs = [
+        {"cow_id_a": labels[a], "cow_id_b": labels[b], "similarity": round(similarity, 4)}
+        for similarity, a, b in sorted(heap, reverse=True)
+    ]
+    return {
+        "threshold": threshold,
+        "cows_checked": n,
+        "pairs_found": total_found,
+        "truncated": total_found > len(pairs),
+        "pairs": pairs
+    }
@@ -0,0 +1,156 @@
+import io
+import os
+import time
+import numpy as np
+import cv2
+from PIL import Image
+
+# Fonctions de décodage, de détection et de prétraitement indépendantes du framework d'inférence :
+# le détecteur est passé en paramètre, detector(image, conf, imgsz) -> [x1, y1, x2, y2] ou None
+
+
+def preprocess_crop(img_np, size=224):
+    """Crop BGR -> tenseur (1, size, size, 3) RGB normalisé sur [0, 1] attendu par l'embedder"""
+    img = Image.fromarray(cv2.cvtColor(img_np, cv2.COLOR_BGR2RGB))
+    img = img.resize((size, size))
+    x = np.asarray(img, dtype=np.float32) / 255.0
+    return np.expand_dims(x, axis=0)
+
+
+# Décodage JPEG réduit natif d'OpenCV (facteurs 1/2, 1/4, 1/8)
+_REDUCED_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def _elapsed_ms(start):
+    return round((time.perf_counter() - start) * 1000, 2)
+
+
+def decode_image(data, working_side=None):
+    """
+    Décode une image directement à une résolution de travail réduite
+
+    Lit seulement l'en-tête pour connaître la taille, puis choisit le plus grand
+    facteur de réduction (1, 2, 4, 8) qui garde le grand côté >= working_side.
+
+    Returns:
+        tuple: (image BGR ou None, facteur de réduction, (largeur, hauteur) d'origine)
+    """
+    working_side = working_side or int(os.getenv('DETECTION_WORKING_SIDE', '1600'))
+    try:
+        width, height = Image.open(io.BytesIO(data)).size
+    except Exception:
+        width = height = None
+
+    factor = 1
+    if width and height:
+        for candidate in (8, 4, 2):
+            if max(width, height) / candidate >= working_side:
+                factor = candidate
+                break
+
+    buffer = np.frombuffer(data, np.uint8)
+    img = cv2.imdecode(buffer, _REDUCED_FLAGS[factor])
+    if img is None and factor != 1:
+        factor = 1
+        img = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    if img is not None and not width:
+        height, width = img.shape[0] * factor, img.shape[1] * factor
+    return img, factor, (width, height)
+
+
+def detect_muzzle_from_bytes(data, detector, conf=0.5, detect_size=None, min_crop_side=None):
+    """
+    Détection du museau sur une image réduite, crop à la résolution juste suffisante
+
+    - Décodage à une résolution de travail (decode_image)
+    - Détecteur sur une copie dont le grand côté vaut detect_size (taille d'entrée du modèle)
+    - Boîte ramenée à la résolution de travail ; si le crop y est plus petit que
+      min_crop_side (taille d'entrée de l'embedder), l'image est redécodée au plus fort
+      facteur de réduction qui donne un crop assez grand (temps compté dans "decode")
+
+    Returns:
+        tuple: (crop BGR ou None, infos {"decoded": False si l'image est illisible,
+                résolutions, "timings_ms"})
+    """
+    detect_size = detect_size or int(os.getenv('DETECTION_IMAGE_SIZE', '640'))
+    min_crop_side = min_crop_side or int(os.getenv('EMBEDDING_INPUT_SIZE', '224'))
+    timings = {}
+    info = {"decoded": False, "timings_ms": timings}
+
+    start = time.perf_counter()
+    working, factor, (width, height) = decode_image(data)
+    timings["decode"] = _elapsed_ms(start)
+    if working is None:
+        return None, info
+    info.update({
+        "decoded": True,
+        "original_resolution": [width, height],
+        "working_resolution": [working.shape[1], working.shape[0]],
+        "decode_reduction": factor
+    })
+
+    start = time.perf_counter()
+    scale = min(1.0, detect_size / max(working.shape[:2]))
+    if scale < 1.0:
+        detect_img = cv2.resize(working, (max(1, int(round(working.shape[1] * scale))), max(1, int(round(working.shape[0] * scale)))), interpolation=cv2.INTER_AREA)
+    else:
+        detect_img = working
+    timings["resize"] = _elapsed_ms(start)
+    info["detection_resolution"] = [detect_img.shape[1], detect_img.shape[0]]
+
+    start = time.perf_counter()
+    box = detector(detect_img, conf, detect_size)
+    timings["detect"] = _elapsed_ms(start)
+    if box is None:
+        return None, info
+
+    start = time.perf_counter()
+    x1, y1, x2, y2 = (np.asarray(box, dtype=np.float64) / scale).tolist()
+    x1, y1 = max(0, int(x1)), max(0, int(y1))
+    x2, y2 = min(working.shape[1], int(x2)), min(working.shape[0], int(y2))
+    cropped = working[y1:y2, x1:x2]
+    info["crop_source"] = "working"
+    timings["crop"] = _elapsed_ms(start)
+
+    crop_side = min(cropped.shape[:2])
+    if factor > 1 and 0 < crop_side < min_crop_side:
+        # Trop peu de pixels pour l'embedder : redécoder au facteur le plus réduit suffisant
+        refactor = next((c for c in (4, 2) if c < factor and crop_side * factor / c >= min_crop_side), 1)
+        start = time.perf_counter()
+        sharper = cv2.imdecode(np.frombuffer(data, np.uint8), _REDUCED_FLAGS[refactor])
+        timings["decode"] = round(timings["decode"] + _elapsed_ms(start), 2)
+        if sharper is not None:
+            start = time.perf_counter()
+            fx = sharper.shape[1] / working.shape[1]
+            fy = sharper.shape[0] / working.shape[0]
+            cropped = sharper[int(y1 * fy):int(y2 * fy), int(x1 * fx):int(x2 * fx)]
+            info["crop_source"] = "full" if refactor == 1 else f"reduced_{refactor}"
+            timings["crop"] = round(timings["crop"] + _elapsed_ms(start), 2)
+    info["crop_resolution"] = [cropped.shape[1], cropped.shape[0]]
+
+    if cropped.size == 0:
+        return None, info
+    return cropped, info
+
+
+def detect_muzzle_full_resolution(data, detector, conf=0.5):
+    """Chemin historique (décodage et détection en pleine résolution), pour comparer les temps"""
+    timings = {}
+    start = time.perf_counter()
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    timings["decode"] = _elapsed_ms(start)
+    if img is None:
+        return None, {"decoded": False, "timings_ms": timings}
+    start = time.perf_counter()
+    box = detector(img, conf, int(os.getenv('DETECTION_IMAGE_SIZE', '640')))
+    cropped = None
+    if box is not None:
+        x1, y1, x2, y2 = map(int, box)
+        cropped = img[max(0, y1):y2, max(0, x1):x2]
+    timings["detect"] = _elapsed_ms(start)
+    return cropped, {"decoded": True, "original_resolution": [img.shape[1], img.shape[0]], "timings_ms": timings}
@@ -0,0 +1,474 @@
+import os
+import json
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Proportion de lignes supprimées au-delà de laquelle la matrice est compactée
+COMPACTION_RATIO = 0.25
+
+# Seuil d'identification par défaut (sans calibration)
+DEFAULT_THRESHOLD = 0.91
+
+# Fichiers de la copie locale mappée en mémoire (save_memmap / load_memmap) : l'index JSON
+# désigne par son nom la matrice qu'il décrit (embeddings-<version>-<id>.npy)
+MEMMAP_MATRIX_FILE = "embeddings.npy"
+MEMMAP_MATRIX_PREFIX = "embeddings-"
+MEMMAP_INDEX_FILE = "embeddings.json"
+# Âge au-delà duquel une matrice qui n'est plus référencée par l'index est supprimée
+# (délai laissé aux processus qui viennent de lire l'index précédent pour l'ouvrir)
+MEMMAP_STALE_SECONDS = 300
+
+
+class EmbeddingStore:
+    """
+    Base d'embeddings en mémoire avec index label -> ligne
+
+    - Recherche, ajout et suppression d'une vache en O(1) (dictionnaire)
+    - Embeddings dans une matrice numpy préallouée (ajouts amortis en O(1))
+    - Suppressions par tombstone (ligne marquée morte), compaction quand
+      la proportion de lignes mortes dépasse COMPACTION_RATIO
+    - Métadonnées par vache précalculées (date d'enrôlement, nombre d'images)
+    """
+
+    def __init__(self, dim=None, capacity=64):
+        self._dim = dim
+        self._capacity = capacity
+        self._size = 0
+        self._matrix = None
+        self._norms = np.zeros(0, dtype=np.float32)
+        self._alive = np.zeros(0, dtype=bool)
+        self._labels = []
+        self._index = {}
+        self._metadata = {}
+        self._deleted = 0
+        self._ordered = None
+        self._lock = threading.RLock()
+        # Résultat de la calibration hors ligne (seuil global recommandé), voir calibrate.py
+        self.calibration = None
+        # Labels présents plusieurs fois dans le JSON chargé par from_dict (seule la dernière entrée est gardée)
+        self.duplicate_labels = []
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Construit la base à partir du format JSON {"labels", "embeddings", "metadata"}
+
+        L'ancien format (listes parallèles) peut contenir un même label plusieurs fois :
+        la dernière entrée l'emporte, comme pour add(), et les doublons sont journalisés
+        et conservés dans duplicate_labels.
+        """
+        labels = data.get("labels", [])
+        embeddings = data.get("embeddings", [])
+        metadata = data.get("metadata", {})
+        if len(labels) != len(embeddings):
+            raise ValueError(f"Base invalide: {len(labels)} labels pour {len(embeddings)} embeddings")
+        store = cls(capacity=max(64, len(labels)))
+        duplicates = set()
+        for label, emb in zip(labels, embeddings):
+            if store.add(label, emb, metadata.get(label)):
+                duplicates.add(label)
+        store.calibration = data.get("calibration")
+        if duplicates:
+            store.duplicate_labels = sorted(duplicates)
+            logger.warning(
+                f"{len(duplicates)} labels en double dans la base chargée, dernière entrée conservée: "
+                f"{', '.join(store.duplicate_labels[:20])}{'...' if len(duplicates) > 20 else ''}"
+            )
+        return store
+
+    def save_memmap(self, directory, **extra):
+        """
+        Écrit la base dans directory : matrice .npy (lignes actives) + labels/métadonnées JSON
+
+        Chaque écriture crée une nouvelle matrice au nom unique, puis remplace l'index
+        qui la désigne : plusieurs écrivains (threads, workers uvicorn) sur le même
+        dossier ne se marchent jamais dessus et un index décrit toujours sa matrice.
+
+        Args:
+            extra: Champs ajoutés à l'index JSON (version, etag...)
+
+        Returns:
+            dict: Index écrit (à passer à load_memmap pour rouvrir exactement cette version)
+        """
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            labels = self.labels
+            rows = np.array([self._index[label] for label in labels], dtype=np.int64)
+            matrix = self._matrix[rows] if len(rows) else np.zeros((0, self._dim or 0), dtype=np.float32)
+            metadata = {label: dict(self._metadata.get(label, {})) for label in labels}
+            calibration = self.calibration
+            dim = self._dim
+        matrix_file = f"{MEMMAP_MATRIX_PREFIX}{extra.get('version', 0)}-{uuid.uuid4().hex[:12]}.npy"
+        index = {
+            "labels": labels,
+            "dim": dim,
+            "matrix": matrix_file,
+            "metadata": metadata,
+            "calibration": calibration,
+            **extra
+        }
+        # Matrice d'abord (nom unique, jamais référencée avant d'être complète), index en dernier
+        with open(os.path.join(directory, matrix_file), "wb") as f:
+            np.save(f, matrix)
+        index_path = os.path.join(directory, MEMMAP_INDEX_FILE)
+        tmp_path = f"{index_path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+        self._remove_stale_memmaps(directory)
+        return index
+
+    @staticmethod
+    def _remove_stale_memmaps(directory):
+        """Supprime les matrices et fichiers temporaires que l'index courant ne référence plus"""
+        try:
+            with open(os.path.join(directory, MEMMAP_INDEX_FILE)) as f:
+                current = json.load(f).get("matrix", MEMMAP_MATRIX_FILE)
+        except (OSError, ValueError):
+            return
+        limit = time.time() - MEMMAP_STALE_SECONDS
+        for name in os.listdir(directory):
+            stale = name == MEMMAP_MATRIX_FILE or name.startswith(MEMMAP_MATRIX_PREFIX) or '.tmp-' in name
+            if not stale or name == current:
+                continue
+            path = os.path.join(directory, name)
+            try:
+                if os.stat(path).st_mtime < limit:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    @classmethod
+    def load_memmap(cls, directory, index=None):
+        """
+        Ouvre une base écrite par save_memmap sans charger la matrice en mémoire
+
+        La matrice est mappée en copie sur écriture (mmap_mode="c") : les pages sont lues
+        à la demande et restent récupérables par le système ; un ajout ou une suppression
+        ne modifie que la copie du processus, jamais le fichier.
+
+        Args:
+            index: Index retourné par save_memmap (défaut : index courant du dossier)
+
+        Returns:
+            tuple: (base, index JSON avec les champs extra)
+        """
+        if index is None:
+            with open(os.path.join(directory, MEMMAP_INDEX_FILE)) as f:
+                index = json.load(f)
+        labels = index["labels"]
+        store = cls(dim=index.get("dim"), capacity=max(len(labels), 1))
+        if labels:
+            # Une matrice vide ne peut pas être mappée : elle n'est ouverte que s'il y a des vaches
+            matrix_path = os.path.join(directory, index.get("matrix", MEMMAP_MATRIX_FILE))
+            matrix = np.load(matrix_path, mmap_mode="c")
+            if matrix.shape != (len(labels), index.get("dim") or matrix.shape[1]):
+                raise ValueError(f"Copie locale incohérente: matrice {matrix.shape} pour {len(labels)} labels")
+            store._matrix = matrix
+            store._norms = np.linalg.norm(matrix, axis=1).astype(np.float32)
+            store._alive = np.ones(len(labels), dtype=bool)
+        store._size = len(labels)
+        store._labels = list(labels)
+        store._index = {label: row for row, label in enumerate(labels)}
+        store._metadata = {label: dict(index["metadata"].get(label, {})) for label in labels}
+        store.calibration = index.get("calibration")
+        return store, index
+
+    def copy(self):
+        """Copie indépendante (pour construire une nouvelle version sans toucher à celle en service)"""
+        with self._lock:
+            store = EmbeddingStore(dim=self._dim, capacity=self._capacity)
+            if self._matrix is not None:
+                store._matrix = self._matrix.copy()
+                store._norms = self._norms.copy()
+                store._alive = self._alive.copy()
+            store._size = self._size
+            store._labels = list(self._labels)
+            store._index = dict(self._index)
+            store._metadata = {label: dict(meta) for label, meta in self._metadata.items()}
+            store._deleted = self._deleted
+            store.calibration = dict(self.calibration) if self.calibration else None
+            return store
+
+    def apply_operations(self, operations):
+        """
+        Applique des opérations du journal :
+        {"op": "add", "label", "embedding", "metadata"} | {"op": "remove", "label"}
+        | {"op": "calibrate", "thresholds": {label: seuil}, "calibration": {...}}
+
+        Une calibration remplace tous les seuils par vache : ceux d'une calibration
+        précédente absents de thresholds sont effacés (le seuil global s'applique).
+        """
+        for op in operations:
+            if op["op"] == "add":
+                self.add(op["label"], op["embedding"], op.get("metadata"))
+            elif op["op"] == "remove":
+                self.remove(op["label"])
+            elif op["op"] == "calibrate":
+                with self._lock:
+                    for meta in self._metadata.values():
+                        meta.pop("threshold", None)
+                    for label, threshold in op.get("thresholds", {}).items():
+                        self.update_metadata(label, threshold=threshold)
+                    if op.get("calibration") is not None:
+                        self.calibration = op["calibration"]
+            else:
+                raise ValueError(f"Opération inconnue: {op['op']}")
+
+    def to_dict(self):
+        """Format JSON de la base (seulement les vaches actives)"""
+        with self._lock:
+            rows = [self._index[label] for label in self.labels]
+            data = {
+                "labels": self.labels,
+                "embeddings": [self._matrix[row].tolist() for row in rows],
+                "metadata": {label: dict(self._metadata.get(label, {})) for label in self.labels}
+            }
+            if self.calibration:
+                data["calibration"] = self.calibration
+            return data
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, label):
+        return label in self._index
+
+    @property
+    def dim(self):
+        return self._dim
+
+    @property
+    def labels(self):
+        """Labels actifs dans l'ordre d'enrôlement (liste précalculée, invalidée à chaque modification)"""
+        ordered = self._ordered
+        if ordered is None:
+            with self._lock:
+                ordered = [self._labels[row] for row in range(self._size) if self._alive[row]]
+                self._ordered = ordered
+        return ordered
+
+    def _grow(self, needed):
+        capacity = max(self._capacity, 1)
+        while capacity < needed:
+            capacity *= 2
+        matrix = np.zeros((capacity, self._dim), dtype=np.float32)
+        norms = np.zeros(capacity, dtype=np.float32)
+        alive = np.zeros(capacity, dtype=bool)
+        if self._matrix is not None:
+            matrix[:self._size] = self._matrix[:self._size]
+            norms[:self._size] = self._norms[:self._size]
+            alive[:self._size] = self._alive[:self._size]
+        self._matrix, self._norms, self._alive = matrix, norms, alive
+        self._capacity = capacity
+
+    def add(self, label, embedding, metadata=None):
+        """
+        Ajoute une vache (ou remplace l'embedding si le label existe déjà)
+
+        Returns:
+            bool: True si la vache existait déjà (embedding remplacé)
+        """
+        emb = np.asarray(embedding, dtype=np.float32).ravel()
+        with self._lock:
+            if self._dim is None:
+                self._dim = emb.shape[0]
+            elif emb.shape[0] != self._dim:
+                raise ValueError(f"Dimension d'embedding invalide: {emb.shape[0]} (attendu: {self._dim})")
+
+            meta = dict(metadata or {})
+            meta.setdefault("enrolled_at", datetime.now(timezone.utc).isoformat())
+
+            existed = label in self._index
+            if existed:
+                row = self._index[label]
+            else:
+                if self._matrix is None or self._size >= self._capacity:
+                    self._grow(self._size + 1)
+                row = self._size
+                self._size += 1
+                self._labels.append(label)
+                self._index[label] = row
+                self._alive[row] = True
+                self._ordered = None
+
+            self._matrix[row] = emb
+            self._norms[row] = np.linalg.norm(emb)
+            self._metadata[label] = meta
+            return existed
+
+    def remove(self, label):
+        """
+        Supprime une vache (tombstone, compaction automatique)
+
+        Returns:
+            bool: False si la vache n'existe pas
+        """
+        with self._lock:
+            row = self._index.pop(label, None)
+            if row is None:
+                return False
+            self._alive[row] = False
+            self._metadata.pop(label, None)
+            self._deleted += 1
+            self._ordered = None
+            if self._deleted > COMPACTION_RATIO * self._size:
+                self.compact()
+            return True
+
+    def compact(self):
+        """Retire physiquement les lignes supprimées de la matrice"""
+        with self._lock:
+            if self._deleted == 0:
+                return
+            keep = np.flatnonzero(self._alive[:self._size])
+            self._matrix[:len(keep)] = self._matrix[keep]
+            self._norms[:len(keep)] = self._norms[keep]
+            self._alive[:] = False
+            self._alive[:len(keep)] = True
+            self._labels = [self._labels[row] for row in keep]
+            self._index = {label: row for row, label in enumerate(self._labels)}
+            self._size = len(keep)
+            self._deleted = 0
+            self._ordered = None
+
+    def get_embedding(self, label):
+        with self._lock:
+            row = self._index.get(label)
+            return None if row is None else self._matrix[row].copy()
+
+    def get_metadata(self, label):
+        with self._lock:
+            meta = self._metadata.get(label)
+            return None if meta is None else dict(meta)
+
+    def threshold_for(self, label, default):
+        """Seuil d'acceptation d'une vache : calibré par vache, sinon global calibré, sinon default (O(1))"""
+        meta = self._metadata.get(label)
+        if meta and meta.get("threshold") is not None:
+            return meta["threshold"]
+        if self.calibration and self.calibration.get("threshold") is not None:
+            return self.calibration["threshold"]
+        return default
+
+    def update_metadata(self, label, **fields):
+        with self._lock:
+            if label in self._metadata:
+                self._metadata[label].update(fields)
+
+    def page(self, offset=0, limit=100):
+        """
+        Page de la liste des vaches avec leurs métadonnées
+
+        Returns:
+            list: [{"cow_id", "index", ...métadonnées}]
+        """
+        labels = self.labels[offset:offset + limit]
+        with self._lock:
+            return [
+                {"cow_id": label, "index": offset + i, **self._metadata.get(label, {})}
+                for i, label in enumerate(labels)
+            ]
+
+    def similarities(self, query_emb):
+        """
+        Similarités cosinus entre un embedding et toutes les lignes de la matrice
+
+        Returns:
+            np.ndarray: une valeur par ligne, -inf pour les lignes supprimées
+        """
+        q = np.asarray(query_emb, dtype=np.float32).ravel()
+        with self._lock:
+            matrix = self._matrix[:self._size]
+            norms = self._norms[:self._size]
+            alive = self._alive[:self._size]
+            q_norm = np.linalg.norm(q)
+            denom = np.maximum(norms * q_norm, 1e-12)
+            sims = (matrix @ q) / denom
+            sims[~alive] = -np.inf
+            return sims
+
+    def similarities_batch(self, queries):
+        """
+        Similarités cosinus d'un lot d'embeddings avec les vaches actives, en un seul produit matriciel
+
+        Labels et similarités sont lus sous le même verrou, avec les normes déjà
+        stockées : ni copie ni renormalisation de la matrice.
+
+        Returns:
+            tuple: (labels actifs, np.ndarray de forme (nombre de requêtes, nombre de labels))
+        """
+        q = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        q_norms = np.linalg.norm(q, axis=1)
+        with self._lock:
+            rows = np.flatnonzero(self._alive[:self._size])
+            labels = [self._labels[row] for row in rows]
+            if len(rows) == 0:
+                return labels, np.zeros((len(q), 0), dtype=np.float32)
+            sims = (q @ self._matrix[:self._size].T)[:, rows]
+            sims /= np.maximum(q_norms[:, None] * self._norms[rows][None, :], 1e-12)
+            return labels, sims
+
+    def active_rows(self):
+        """
+        Lignes actives de la matrice
+
+        Returns:
+            tuple: (labels, embeddings normalisés (copie), dans l'ordre d'enrôlement)
+        """
+        with self._lock:
+            labels = self.labels
+            rows = np.array([self._index[label] for label in labels], dtype=np.int64)
+            if len(rows) == 0:
+                return labels, np.zeros((0, self._dim or 0), dtype=np.float32)
+            matrix = self._matrix[rows] / np.maximum(self._norms[rows], 1e-12)[:, None]
+            return labels, matrix
+
+    def best_match(self, query_emb):
+        """
+        Vache la plus proche d'un embedding
+
+        Returns:
+            tuple: (label, score) ou (None, 0.0) si la base est vide
+        """
+        with self._lock:
+            if len(self._index) == 0:
+                return None, 0.0
+            sims = self.similarities(query_emb)
+            best_row = int(np.argmax(sims))
+            return self._labels[best_row], float(sims[best_row])
+
+    def stats(self):
+        with self._lock:
+            return {
+                "active_cows": len(self._index),
+                "rows": self._size,
+                "tombstones": self._deleted,
+                "capacity": self._capacity,
+                "embedding_dim": self._dim,
+                "duplicate_labels": list(self.duplicate_labels),
+                # Matrice encore adossée au fichier de load_memmap (une copie ou un agrandissement la remet en mémoire)
+                "memory_mapped": getattr(self._matrix, "filename", None) is not None
+            }
+
+
+def match_identity(query_emb, store, threshold=DEFAULT_THRESHOLD):
+    """
+    Identifie la vache la plus proche d'un embedding
+
+    Returns:
+        tuple: (label, score), ("INCONNUE", score) sous le seuil, ("BASE_VIDE", 0.0) si la base est vide
+    """
+    if len(store) == 0:
+        return "BASE_VIDE", 0.0
+    best_label, best_score = store.best_match(query_emb)
+    # Seuil calibré hors ligne (par vache ou global) s'il existe, sinon threshold
+    if best_score < store.threshold_for(best_label, threshold):
+        return "INCONNUE", float(best_score)
+    return best_label, float(best_score)
@@ -0,0 +1,88 @@
+import os
+import sys
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Modules lourds surveillés : leur présence dans sys.modules signale une régression du profil edge
+HEAVY_MODULES = ("tensorflow", "torch", "ultralytics", "sklearn", "boto3", "botocore", "onnxruntime")
+
+
+def peak_rss_mb():
+    """RSS maximale du processus depuis son démarrage (Mo), None si indisponible"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss est en octets sous macOS, en Ko sous Linux
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def current_rss_mb():
+    """RSS actuelle du processus (Mo), lue dans /proc ; à défaut la RSS maximale"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return peak_rss_mb()
+
+
+def _round(value, digits=1):
+    return None if value is None else round(value, digits)
+
+
+class FootprintReport:
+    """
+    Empreinte du démarrage : durée, RSS et modules importés à chaque étape
+
+    mark(étape) enregistre ce qui s'est passé depuis l'étape précédente. Le rapport
+    est comparé à FOOTPRINT_BUDGET_MB (0 = pas de budget) pour détecter les régressions.
+    """
+
+    def __init__(self):
+        self._start = self._last_time = time.perf_counter()
+        self.baseline_rss_mb = current_rss_mb()
+        self._last_rss = self.baseline_rss_mb
+        self._last_modules = len(sys.modules)
+        self.stages = []
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        rss = current_rss_mb()
+        modules = len(sys.modules)
+        entry = {
+            "stage": stage,
+            "seconds": round(now - self._last_time, 3),
+            "rss_mb": _round(rss),
+            "rss_delta_mb": _round(rss - self._last_rss if rss is not None and self._last_rss is not None else None),
+            "modules_loaded": modules - self._last_modules
+        }
+        self.stages.append(entry)
+        logger.info(f"Empreinte [{stage}]: {entry['seconds']}s, RSS {entry['rss_mb']} Mo (delta {entry['rss_delta_mb']} Mo)")
+        self._last_time, self._last_rss, self._last_modules = now, rss, modules
+        return entry
+
+    def heavy_modules(self):
+        loaded = {name.split(".")[0] for name in sys.modules}
+        return sorted(loaded.intersection(HEAVY_MODULES))
+
+    def report(self, budget_mb=None):
+        budget = budget_mb if budget_mb is not None else float(os.getenv('FOOTPRINT_BUDGET_MB', '0'))
+        rss = current_rss_mb()
+        return {
+            "startup_seconds": round(self._last_time - self._start, 3),
+            "baseline_rss_mb": _round(self.baseline_rss_mb),
+            "rss_mb": _round(rss),
+            "peak_rss_mb": _round(peak_rss_mb()),
+            "stages": list(self.stages),
+            "heavy_modules": self.heavy_modules(),
+            "budget_mb": budget or None,
+            "within_budget": (rss <= budget) if budget and rss is not None else None
+        }
+
+
+# Créé au premier import (en tête de main.py) : la référence est l'interpréteur seul
+footprint = FootprintReport()
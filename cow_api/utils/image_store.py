@@ -0,0 +1,378 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from utils.storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+MUZZLE_PREFIX = "muzzle_images"
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+# Marqueur écrit à côté d'un objet épinglé (crop pas encore envoyé), retiré par unpin()
+PIN_SUFFIX = ".pinned"
+# Âge au-delà duquel un fichier temporaire est considéré abandonné (un autre processus peut écrire)
+TMP_STALE_SECONDS = 3600
+
+
+class LocalDiskCache:
+    """
+    Cache disque local borné (LRU) pour les objets du stockage
+
+    Les objets sont rangés sous cache_dir/<clé>. Quand la taille totale dépasse
+    max_bytes, les objets les moins récemment utilisés sont supprimés, sauf ceux
+    épinglés (crops pas encore envoyés sur S3). L'épinglage est persisté par un
+    marqueur : après un arrêt brutal, les objets encore épinglés sont listés dans
+    recovered_pins pour être renvoyés.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = os.path.abspath(cache_dir or os.getenv('IMAGE_CACHE_DIR', 'image_cache'))
+        self.max_bytes = max_bytes if max_bytes is not None else int(float(os.getenv('IMAGE_CACHE_MAX_MB', '1024')) * 1024 * 1024)
+        self._entries = OrderedDict()  # clé -> taille, de la moins à la plus récemment utilisée
+        self._pinned = set()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.recovered_pins = []
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load_existing()
+
+    def _path(self, key):
+        path = os.path.abspath(os.path.join(self.cache_dir, key))
+        if os.path.commonpath([path, self.cache_dir]) != self.cache_dir:
+            raise ValueError(f"Clé invalide: {key}")
+        return path
+
+    def _load_existing(self):
+        """Reprend le contenu du cache laissé par un démarrage précédent (ordre LRU = mtime)"""
+        files = []
+        pins = set()
+        stale = time.time() - TMP_STALE_SECONDS
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if '.tmp-' in filename:
+                    # Un fichier récent peut être en cours d'écriture par un autre worker
+                    if stat.st_mtime < stale:
+                        self._remove(path)
+                    continue
+                key = os.path.relpath(path, self.cache_dir).replace(os.sep, '/')
+                if filename.endswith(PIN_SUFFIX):
+                    pins.add(key[:-len(PIN_SUFFIX)])
+                    continue
+                files.append((stat.st_mtime, key, stat.st_size))
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+            self._total_bytes += size
+        for key in pins:
+            if key in self._entries:
+                self._pinned.add(key)
+                self.recovered_pins.append(key)
+            else:
+                self._remove(self._path(key) + PIN_SUFFIX)
+        self._evict()
+        if files:
+            logger.info(f"Cache images: {len(self._entries)} fichiers repris ({self._total_bytes / 1024 / 1024:.1f} MB)")
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def get(self, key):
+        """Retourne le contenu en cache ou None"""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            self.discard(key)
+            return None
+
+    def put(self, key, data, pinned=False):
+        """Ajoute un objet au cache ; pinned=True le protège de l'éviction jusqu'à unpin()"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        if pinned:
+            # Marqueur écrit avant l'enregistrement : un arrêt brutal ne perd pas l'épinglage
+            with open(path + PIN_SUFFIX, 'wb'):
+                pass
+        with self._lock:
+            self._total_bytes += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            if pinned:
+                self._pinned.add(key)
+            self._evict()
+
+    def unpin(self, key):
+        self._remove(self._path(key) + PIN_SUFFIX)
+        with self._lock:
+            self._pinned.discard(key)
+            self._evict()
+
+    def discard(self, key):
+        """Retire un objet du cache"""
+        with self._lock:
+            self._total_bytes -= self._entries.pop(key, 0)
+            self._pinned.discard(key)
+        self._remove(self._path(key) + PIN_SUFFIX)
+        self._remove(self._path(key))
+
+    def _evict(self):
+        # Appelé avec self._lock
+        if self._total_bytes <= self.max_bytes:
+            return
+        for key in list(self._entries):
+            if self._total_bytes <= self.max_bytes:
+                break
+            if key in self._pinned:
+                continue
+            self._total_bytes -= self._entries.pop(key)
+            self._remove(self._path(key))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "cache_dir": self.cache_dir,
+                "files": len(self._entries),
+                "size_bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "pinned": len(self._pinned),
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+class TieredImageStore:
+    """
+    Stockage des images à deux niveaux : cache disque local (LRU) devant le stockage S3
+
+    - Images brutes : lecture à travers le cache (un seul téléchargement par nœud)
+    - Crops de museaux : écrits dans le cache puis envoyés sur S3 en arrière-plan
+      sous muzzle_images/{cow_id}/
+    - Index des crops par vache en mémoire, construit à partir d'un seul listing S3
+    """
+
+    def __init__(self, storage=None, cache=None, upload_workers=None):
+        self.storage = storage or get_storage()
+        self.cache = cache or LocalDiskCache()
+        workers = upload_workers or int(os.getenv('CROP_UPLOAD_WORKERS', '4'))
+        self.upload_retries = max(1, int(os.getenv('CROP_UPLOAD_RETRIES', '3')))
+        self.upload_retry_delay = float(os.getenv('CROP_UPLOAD_RETRY_DELAY', '1'))
+        self.failed_uploads = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="crop-upload")
+        self._pending = {}  # clé -> Future
+        self._crop_index = {}  # cow_id -> set de noms de fichiers
+        self._lock = threading.Lock()
+        self.refresh_index()
+        self._requeue_recovered_crops()
+
+    def _requeue_recovered_crops(self):
+        """Renvoie les crops restés épinglés (pas encore envoyés) lors d'un arrêt brutal"""
+        requeued = 0
+        for key in self.cache.recovered_pins:
+            parts = key.split('/')
+            data = self.cache.get(key)
+            if len(parts) != 3 or parts[0] != MUZZLE_PREFIX or data is None:
+                logger.warning(f"Objet épinglé abandonné: {key}")
+                self.cache.discard(key)
+                continue
+            with self._lock:
+                self._crop_index.setdefault(parts[1], set()).add(parts[2])
+                self._pending[key] = self._executor.submit(self._upload, key, data)
+            requeued += 1
+        if requeued:
+            logger.info(f"{requeued} museaux non envoyés repris après un arrêt")
+        self.cache.recovered_pins = []
+
+    @staticmethod
+    def muzzle_prefix(cow_id):
+        return f"{MUZZLE_PREFIX}/{cow_id}/"
+
+    def muzzle_location(self, cow_id):
+        """Emplacement des crops d'une vache dans le stockage"""
+        return self.storage.uri(self.muzzle_prefix(cow_id))
+
+    def refresh_index(self):
+        """Reconstruit l'index des crops depuis le stockage (un seul listing pour toutes les vaches)"""
+        index = {}
+        try:
+            for key in self.storage.list_objects(f"{MUZZLE_PREFIX}/"):
+                parts = key.split('/')
+                if len(parts) != 3 or not parts[2].lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                index.setdefault(parts[1], set()).add(parts[2])
+        except Exception as e:
+            logger.error(f"Impossible de construire l'index des museaux: {e}")
+            return False
+        with self._lock:
+            # Les crops en cours d'envoi ne sont pas encore visibles dans le stockage
+            for key in self._pending:
+                _, cow_id, filename = key.split('/')
+                index.setdefault(cow_id, set()).add(filename)
+            self._crop_index = index
+        logger.info(f"Index des museaux: {len(index)} vaches")
+        return True
+
+    @staticmethod
+    def _versioned_key(key, etag):
+        # Une nouvelle version de l'objet (ETag différent) ne retrouve pas l'ancienne entrée du cache
+        return f"{key}@{etag}" if etag else key
+
+    def get_raw_image(self, key):
+        """
+        Lit une image brute via le cache local (téléchargée depuis le stockage en cas d'absence)
+
+        Le cache est indexé par clé et ETag : chaque lecture revalide l'objet avec un
+        HEAD, de sorte qu'une image remplacée dans le stockage est retéléchargée.
+
+        Returns:
+            bytes: Contenu de l'image, None en cas d'échec
+        """
+        try:
+            etag = self.storage.head_object(key).get("etag")
+        except Exception as e:
+            logger.error(f"Erreur lors de la lecture de {key}: {e}")
+            return None
+        cache_key = self._versioned_key(key, etag)
+        data = self.cache.get(cache_key)
+        if data is not None:
+            return data
+        try:
+            data = self.storage.get_object(key)
+        except Exception as e:
+            logger.error(f"Erreur lors de la lecture de {key}: {e}")
+            return None
+        try:
+            self.cache.put(cache_key, data)
+        except OSError as e:
+            # Disque plein, fichier temporaire retiré... l'image lue reste utilisable
+            logger.warning(f"Impossible de mettre {key} en cache: {e}")
+        return data
+
+    def put_muzzle_crop(self, cow_id, filename, data):
+        """Enregistre un crop localement et planifie son envoi asynchrone vers le stockage"""
+        key = self.muzzle_prefix(cow_id) + filename
+        self.cache.put(key, data, pinned=True)
+        with self._lock:
+            self._crop_index.setdefault(cow_id, set()).add(filename)
+            self._pending[key] = self._executor.submit(self._upload, key, data)
+        return key
+
+    def _upload(self, key, data):
+        """
+        Envoie un crop vers le stockage, avec UPLOAD_RETRIES tentatives
+
+        Après le dernier échec, le crop est retiré de l'index et du cache local :
+        l'index ne doit pas annoncer un crop absent du stockage.
+        """
+        error = None
+        try:
+            for attempt in range(1, self.upload_retries + 1):
+                try:
+                    self.storage.put_object(key, data, content_type='image/jpeg')
+                    logger.info(f"Museau envoyé: {self.storage.uri(key)}")
+                    return
+                except Exception as e:
+                    error = e
+                    logger.warning(f"Échec de l'envoi du museau {key} (tentative {attempt}/{self.upload_retries}): {e}")
+                    if attempt < self.upload_retries:
+                        time.sleep(self.upload_retry_delay * attempt)
+            logger.error(f"Museau {key} abandonné après {self.upload_retries} tentatives: {error}")
+            _, cow_id, filename = key.split('/')
+            with self._lock:
+                crops = self._crop_index.get(cow_id)
+                if crops is not None:
+                    crops.discard(filename)
+                    if not crops:
+                        del self._crop_index[cow_id]
+                self.failed_uploads += 1
+            self.cache.discard(key)
+            raise error
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+            self.cache.unpin(key)
+
+    def list_muzzle_crops(self, cow_id):
+        """Noms des crops d'une vache (depuis l'index, sans accès disque ni S3)"""
+        with self._lock:
+            return sorted(self._crop_index.get(cow_id, ()))
+
+    def count_muzzle_crops(self, cow_id):
+        with self._lock:
+            return len(self._crop_index.get(cow_id, ()))
+
+    def delete_muzzle_crops(self, cow_id):
+        """
+        Supprime tous les crops d'une vache (cache local et stockage)
+
+        Returns:
+            int: Nombre de crops supprimés
+        """
+        with self._lock:
+            filenames = self._crop_index.pop(cow_id, set())
+            pending = [f for k, f in self._pending.items() if k.startswith(self.muzzle_prefix(cow_id))]
+        # Attendre les envois en cours pour ne pas recréer un crop après sa suppression
+        for future in pending:
+            try:
+                future.result()
+            except Exception:
+                pass
+        for filename in filenames:
+            key = self.muzzle_prefix(cow_id) + filename
+            self.cache.discard(key)
+            try:
+                self.storage.delete_object(key)
+            except Exception as e:
+                logger.warning(f"Impossible de supprimer {key}: {e}")
+        return len(filenames)
+
+    def flush(self, timeout=None):
+        """Attend la fin des envois de crops en cours"""
+        with self._lock:
+            pending = list(self._pending.values())
+        for future in pending:
+            try:
+                future.result(timeout=timeout)
+            except Exception:
+                pass
+
+    def pending_uploads(self):
+        with self._lock:
+            return len(self._pending)
+
+    def shutdown(self):
+        self.flush()
+        self._executor.shutdown(wait=True)
+
+    def stats(self):
+        with self._lock:
+            indexed_cows = len(self._crop_index)
+            indexed_crops = sum(len(v) for v in self._crop_index.values())
+            failed_uploads = self.failed_uploads
+        return {
+            "indexed_cows": indexed_cows,
+            "indexed_muzzle_images": indexed_crops,
+            "pending_uploads": self.pending_uploads(),
+            "failed_uploads": failed_uploads,
+            "local_cache": self.cache.stats()
+        }
@@ -1,18 +1,12 @@
-from tensorflow.keras.preprocessing import image
-import numpy as np
-import cv2
 from ultralytics import YOLO
-from PIL import Image
+from utils import detection
+from utils.detection import preprocess_crop
 
 yolo_model = YOLO("utils/new.pt")
 
 
 def load_and_preprocess_image(img_np):
-    img = Image.fromarray(cv2.cvtColor(img_np, cv2.COLOR_BGR2RGB))
-    img = img.resize((224, 224))
-    x = image.img_to_array(img) / 255.0
-    x = np.expand_dims(x, axis=0)
-    return x
+    return preprocess_crop(img_np)
 
     
 def detect_muzzle(image, conf=0.5):
@@ -23,4 +17,22 @@ def detect_muzzle(image, conf=0.5):
         x1, y1, x2, y2 = map(int, box.xyxy[0].cpu().numpy())
         cropped = image[y1:y2, x1:x2]
         return cropped
-    return None
\ No newline at end of file
+    return None
+
+
+def yolo_box(image, conf=0.5, imgsz=640):
+    """Boîte [x1, y1, x2, y2] du museau le plus probable (détecteur de utils/detection.py)"""
+    results = list(yolo_model(image, conf=conf, imgsz=imgsz, verbose=False))
+    boxes = results[0].boxes
+    if boxes is None or len(boxes) == 0:
+        return None
+    return boxes[0].xyxy[0].cpu().numpy().tolist()
+
+
+def detect_muzzle_from_bytes(data, conf=0.5, detect_size=None, min_crop_side=None):
+    """Décodage réduit + YOLO, voir detection.detect_muzzle_from_bytes"""
+    return detection.detect_muzzle_from_bytes(data, yolo_box, conf, detect_size, min_crop_side)
+
+
+def detect_muzzle_full_resolution(data, conf=0.5):
+    return detection.detect_muzzle_full_resolution(data, yolo_box, conf)
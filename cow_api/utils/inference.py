@@ -0,0 +1,157 @@
+import os
+import time
+import logging
+import numpy as np
+import cv2
+from utils.detection import detect_muzzle_from_bytes, detect_muzzle_full_resolution, preprocess_crop
+
+logger = logging.getLogger(__name__)
+
+
+class LocalInference:
+    """
+    Inférence dans le processus courant (mode par défaut)
+
+    Les modèles (YOLO + Keras) sont chargés à la création de l'instance.
+    Même interface que InferenceClient (mode serveur, voir utils/inference_server.py).
+    """
+
+    remote = False
+    model_files = ("utils/muzzle.keras", "utils/new.pt")
+
+    def __init__(self):
+        from utils import image_utils, embeddings
+        self._image_utils = image_utils
+        self._embeddings = embeddings
+
+    def detect(self, data, conf=0.5):
+        """
+        Détecte le museau dans une image encodée (JPG, PNG...)
+
+        Returns:
+            tuple: (crop BGR ou None, infos de détection, voir detect_muzzle_from_bytes)
+        """
+        return self._image_utils.detect_muzzle_from_bytes(data, conf)
+
+    def detect_full_resolution(self, data, conf=0.5):
+        """Ancien chemin (pleine résolution), pour comparer les temps"""
+        return self._image_utils.detect_muzzle_full_resolution(data, conf)
+
+    def embed(self, crop):
+        """Embedding d'un crop de museau BGR"""
+        img_tensor = self._image_utils.load_and_preprocess_image(crop)
+        return self._embeddings.get_embedding(img_tensor)
+
+    def predict(self, data, conf=0.5):
+        """
+        Détection + embedding en un seul appel
+
+        Returns:
+            tuple: (museau détecté, infos de détection, embedding ou None)
+            Le crop n'est pas retourné : inutile à /predict, il n'a pas à repasser par la socket en mode serveur
+        """
+        crop, info = self.detect(data, conf)
+        if crop is None:
+            return False, info, None
+        start = time.perf_counter()
+        embedding = self.embed(crop)
+        info["timings_ms"]["embedding"] = round((time.perf_counter() - start) * 1000, 2)
+        return True, info, embedding
+
+    def stats(self):
+        return {"mode": "local", "pid": os.getpid()}
+
+
+class EdgeInference(LocalInference):
+    """
+    Inférence légère pour les boîtiers à mémoire limitée (RUNTIME_PROFILE=edge)
+
+    Détecteur et embedder exportés en ONNX (python export_edge_models.py) et exécutés
+    par ONNX Runtime seul : ni TensorFlow ni PyTorch/ultralytics ne sont importés.
+    """
+
+    def __init__(self, detector_path=None, embedding_path=None, threads=None):
+        import onnxruntime as ort
+        self.model_files = (
+            detector_path or os.getenv('EDGE_DETECTOR_MODEL', 'utils/new.onnx'),
+            embedding_path or os.getenv('EDGE_EMBEDDING_MODEL', 'utils/muzzle_embedding.onnx')
+        )
+        options = ort.SessionOptions()
+        threads = threads if threads is not None else int(os.getenv('EDGE_THREADS', '0'))
+        if threads > 0:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        providers = ["CPUExecutionProvider"]
+        self._detector = ort.InferenceSession(self.model_files[0], sess_options=options, providers=providers)
+        self._embedder = ort.InferenceSession(self.model_files[1], sess_options=options, providers=providers)
+
+        # Tailles d'entrée lues dans les modèles : détecteur (1, 3, S, S), embedder (N, S, S, 3)
+        detector_input = self._detector.get_inputs()[0]
+        self._detector_input = detector_input.name
+        self.detect_size = detector_input.shape[2] if isinstance(detector_input.shape[2], int) else int(os.getenv('DETECTION_IMAGE_SIZE', '640'))
+        embedder_input = self._embedder.get_inputs()[0]
+        self._embedder_input = embedder_input.name
+        self.embedding_size = embedder_input.shape[1] if isinstance(embedder_input.shape[1], int) else 224
+
+    def _box(self, image, conf=0.5, imgsz=None):
+        """Détecteur YOLO ONNX : letterbox, inférence, boîte la plus probable dans les coordonnées de image"""
+        size = self.detect_size
+        height, width = image.shape[:2]
+        scale = min(size / height, size / width)
+        new_w, new_h = max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+        pad_x, pad_y = (size - new_w) // 2, (size - new_h) // 2
+        canvas = np.full((size, size, 3), 114, dtype=np.uint8)
+        canvas[pad_y:pad_y + new_h, pad_x:pad_x + new_w] = (
+            image if (new_w, new_h) == (width, height) else cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+        )
+        blob = cv2.dnn.blobFromImage(canvas, 1 / 255.0, swapRB=True)
+
+        # Sortie YOLOv8 : (1, 4 + classes, propositions), boîtes (cx, cy, w, h) en pixels d'entrée
+        predictions = self._detector.run(None, {self._detector_input: blob})[0][0]
+        scores = predictions[4:].max(axis=0)
+        best = int(np.argmax(scores))
+        if scores[best] < conf:
+            return None
+        cx, cy, w, h = predictions[:4, best]
+        return [
+            (cx - w / 2 - pad_x) / scale,
+            (cy - h / 2 - pad_y) / scale,
+            (cx + w / 2 - pad_x) / scale,
+            (cy + h / 2 - pad_y) / scale
+        ]
+
+    def detect(self, data, conf=0.5):
+        return detect_muzzle_from_bytes(data, self._box, conf, detect_size=self.detect_size, min_crop_side=self.embedding_size)
+
+    def detect_full_resolution(self, data, conf=0.5):
+        return detect_muzzle_full_resolution(data, self._box, conf)
+
+    def embed(self, crop):
+        x = preprocess_crop(crop, self.embedding_size)
+        return self._embedder.run(None, {self._embedder_input: x})[0][0]
+
+    def stats(self):
+        return {"mode": "edge", "runtime": "onnxruntime", "models": list(self.model_files), "pid": os.getpid()}
+
+
+def create_inference(mode=None, profile=None):
+    """
+    Crée le moteur d'inférence selon RUNTIME_PROFILE et INFERENCE_MODE
+
+    - profil edge : modèles ONNX exécutés par ONNX Runtime dans le processus de l'API
+    - local (défaut) : modèles chargés dans le processus de l'API
+    - server : l'API ne charge aucun modèle et envoie les images au serveur
+      d'inférence (python inference_server.py) via la mémoire partagée
+    """
+    profile = (profile or os.getenv('RUNTIME_PROFILE', 'standard')).lower()
+    if profile == "edge":
+        return EdgeInference()
+    mode = (mode or os.getenv('INFERENCE_MODE', 'local')).lower()
+    if mode == "server":
+        from utils.inference_server import InferenceClient
+        client = InferenceClient()
+        logger.info(f"Inférence déléguée au serveur {client.address}")
+        return client
+    if mode != "local":
+        raise ValueError(f"INFERENCE_MODE inconnu: {mode} (attendu: local ou server)")
+    return LocalInference()
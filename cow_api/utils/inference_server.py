@@ -0,0 +1,419 @@
+import os
+import sys
+import signal
+import itertools
+import threading
+import traceback
+import logging
+import multiprocessing as mp
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from multiprocessing import shared_memory
+from multiprocessing.connection import Listener, Client
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Opérations exécutables par les workers (méthodes de LocalInference)
+OPERATIONS = ("detect", "detect_full_resolution", "embed", "predict")
+
+# Adresse par défaut : socket Unix (le serveur est sur la même machine, mémoire partagée oblige)
+DEFAULT_ADDRESS = "/tmp/cow-muzzle-inference.sock"
+
+
+class InferenceError(Exception):
+    """Erreur remontée par le serveur d'inférence (ou serveur injoignable)"""
+
+
+def server_address(value=None):
+    """
+    Adresse du serveur (INFERENCE_SERVER_ADDRESS) : chemin d'une socket Unix (défaut) ou "hôte:port"
+    """
+    value = value or os.getenv('INFERENCE_SERVER_ADDRESS', DEFAULT_ADDRESS)
+    if "/" in value:
+        return value
+    host, _, port = value.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+
+def server_authkey(address):
+    """
+    Clé d'authentification des connexions (INFERENCE_SERVER_AUTHKEY)
+
+    Les messages sont des pickles : sans clé, quiconque peut se connecter exécute du
+    code dans le serveur. Une adresse TCP exige donc une clé ; une socket Unix sans
+    clé n'est accessible qu'à l'utilisateur du serveur (permissions 0600).
+    """
+    key = os.getenv('INFERENCE_SERVER_AUTHKEY')
+    if key:
+        return key.encode()
+    if isinstance(address, str):
+        return None
+    raise ValueError("INFERENCE_SERVER_AUTHKEY est requis pour un serveur d'inférence en TCP")
+
+
+def available_cores():
+    """Cœurs utilisables par ce processus (affinité CPU si disponible)"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def _attach(name):
+    """
+    Ouvre un segment de mémoire partagée créé par un autre processus
+
+    Le segment appartient au client (qui le supprime) : il ne doit pas être suivi
+    par le resource_tracker du serveur, sinon il serait supprimé une seconde fois.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def _configure_threads(threads):
+    """Limite les pools de threads d'OpenCV, TensorFlow et PyTorch dans un worker"""
+    import cv2
+    cv2.setNumThreads(threads)
+    try:
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    except Exception as e:
+        logger.warning(f"Réglage des threads TensorFlow impossible: {e}")
+    try:
+        import torch
+        torch.set_num_threads(threads)
+        torch.set_num_interop_threads(1)
+    except Exception as e:
+        logger.warning(f"Réglage des threads PyTorch impossible: {e}")
+
+
+def _run_task(engine, op, transport):
+    if op not in OPERATIONS:
+        raise ValueError(f"Opération inconnue: {op}")
+    shm = _attach(transport["shm"])
+    view = None
+    try:
+        view = shm.buf[:transport["nbytes"]]
+        # Lecture directe dans la mémoire partagée, sans copie des octets de l'image
+        if transport["kind"] == "array":
+            arg = np.ndarray(transport["shape"], dtype=transport["dtype"], buffer=view)
+        else:
+            arg = view
+        try:
+            return getattr(engine, op)(arg, **transport.get("params", {}))
+        except Exception as e:
+            # Les frames de la trace référencent encore le segment : les vider pour pouvoir le fermer
+            traceback.clear_frames(e.__traceback__)
+            raise
+        finally:
+            del arg
+    finally:
+        if view is not None:
+            try:
+                view.release()
+            except BufferError:
+                logger.warning(f"Segment {transport['shm']} encore référencé à la fin de la tâche {op}")
+        try:
+            shm.close()
+        except BufferError:
+            logger.warning(f"Segment {transport['shm']} non fermé: encore référencé")
+
+
+def _worker_main(worker_id, cores, threads, tasks, results):
+    """Processus worker : charge les modèles une fois puis traite les tâches de la file"""
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    # Avant l'import des frameworks : leurs pools de threads lisent ces variables au chargement
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "TF_NUM_INTRAOP_THREADS"):
+        os.environ[var] = str(threads)
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+    logging.basicConfig(level=logging.INFO)
+    _configure_threads(threads)
+
+    from utils.inference import LocalInference
+    engine = LocalInference()
+    results.put((None, None, True, {"worker": worker_id, "pid": os.getpid(), "cores": cores}))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        conn_id, task_id, op, transport = task
+        try:
+            payload = _run_task(engine, op, transport)
+            ok = True
+        except Exception as e:
+            ok, payload = False, f"{type(e).__name__}: {e}"
+        results.put((conn_id, task_id, ok, payload))
+
+
+class InferenceServer:
+    """
+    Serveur d'inférence : pool de processus workers qui chargent chacun les modèles
+
+    - Chaque worker est épinglé sur INFERENCE_THREADS_PER_WORKER cœurs
+      (os.sched_setaffinity) et limite ses pools de threads à ce nombre : YOLO et
+      Keras ne se disputent plus les cœurs ni le GIL d'un seul processus
+    - Les processus de l'API (uvicorn --workers N) ne chargent aucun modèle : ils se
+      connectent au serveur et déposent les images dans des segments de mémoire
+      partagée ; seuls le nom du segment et les paramètres transitent par la socket
+    - Un worker qui s'arrête est relancé (les requêtes qu'il traitait expirent côté client)
+    """
+
+    def __init__(self, address=None, workers=None, threads_per_worker=None):
+        self.address = server_address(address)
+        self.threads_per_worker = threads_per_worker or int(os.getenv('INFERENCE_THREADS_PER_WORKER', '2'))
+        self.cores = available_cores()
+        self.num_workers = workers or int(os.getenv('INFERENCE_WORKERS', '0')) or max(1, len(self.cores) // self.threads_per_worker)
+        self._ctx = mp.get_context("spawn")
+        self._tasks = self._ctx.Queue()
+        self._results = self._ctx.Queue()
+        self._workers = {}
+        self._connections = {}
+        self._conn_lock = threading.Lock()
+        self._conn_ids = itertools.count()
+        self._stop = threading.Event()
+
+    def _core_set(self, worker_id):
+        """Cœurs du worker : tranches consécutives de threads_per_worker cœurs"""
+        count = min(self.threads_per_worker, len(self.cores))
+        start = (worker_id * count) % len(self.cores)
+        return [self.cores[(start + i) % len(self.cores)] for i in range(count)]
+
+    def _spawn(self, worker_id):
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(worker_id, self._core_set(worker_id), self.threads_per_worker, self._tasks, self._results),
+            name=f"model-worker-{worker_id}",
+            daemon=True
+        )
+        process.start()
+        self._workers[worker_id] = process
+
+    def start(self):
+        for worker_id in range(self.num_workers):
+            self._spawn(worker_id)
+        threading.Thread(target=self._dispatch_results, name="inference-results", daemon=True).start()
+        threading.Thread(target=self._monitor_workers, name="inference-monitor", daemon=True).start()
+        logger.info(f"Serveur d'inférence: {self.num_workers} workers x {self.threads_per_worker} threads")
+
+    def _dispatch_results(self):
+        while not self._stop.is_set():
+            try:
+                conn_id, task_id, ok, payload = self._results.get(timeout=1)
+            except Exception:
+                continue
+            if conn_id is None:
+                logger.info(f"Worker {payload['worker']} prêt (pid {payload['pid']}, cœurs {payload['cores']})")
+                continue
+            with self._conn_lock:
+                entry = self._connections.get(conn_id)
+            if entry is None:
+                continue
+            conn, send_lock = entry
+            try:
+                with send_lock:
+                    conn.send((task_id, ok, payload))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Réponse non envoyée au client {conn_id}: {e}")
+
+    def _monitor_workers(self):
+        while not self._stop.wait(5):
+            for worker_id, process in list(self._workers.items()):
+                if not process.is_alive():
+                    logger.error(f"Worker {worker_id} arrêté (code {process.exitcode}), redémarrage")
+                    self._spawn(worker_id)
+
+    def _handle_client(self, conn_id, conn):
+        try:
+            while not self._stop.is_set():
+                task_id, op, transport = conn.recv()
+                self._tasks.put((conn_id, task_id, op, transport))
+        except (EOFError, OSError):
+            pass
+        finally:
+            with self._conn_lock:
+                self._connections.pop(conn_id, None)
+            conn.close()
+            logger.info(f"Client {conn_id} déconnecté")
+
+    def _listen(self):
+        authkey = server_authkey(self.address)
+        if not isinstance(self.address, str):
+            return Listener(self.address, authkey=authkey)
+        if os.path.exists(self.address):
+            logger.warning(f"Socket {self.address} laissée par un serveur précédent, remplacée")
+            os.unlink(self.address)
+        # Socket créée directement en 0600 : seul l'utilisateur du serveur peut s'y connecter
+        umask = os.umask(0o177)
+        try:
+            return Listener(self.address, authkey=authkey)
+        finally:
+            os.umask(umask)
+
+    def serve_forever(self):
+        # Configuration vérifiée avant de lancer les workers
+        listener = self._listen()
+        self.start()
+        logger.info(f"Serveur d'inférence en écoute sur {self.address}")
+        try:
+            while not self._stop.is_set():
+                try:
+                    conn = listener.accept()
+                except (OSError, EOFError, mp.AuthenticationError) as e:
+                    logger.warning(f"Connexion refusée: {e}")
+                    continue
+                conn_id = next(self._conn_ids)
+                with self._conn_lock:
+                    self._connections[conn_id] = (conn, threading.Lock())
+                threading.Thread(target=self._handle_client, args=(conn_id, conn), daemon=True).start()
+                logger.info(f"Client {conn_id} connecté")
+        finally:
+            listener.close()
+            self.shutdown()
+
+    def shutdown(self):
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        for _ in self._workers:
+            self._tasks.put(None)
+        for process in self._workers.values():
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        logger.info("Serveur d'inférence arrêté")
+
+
+class InferenceClient:
+    """
+    Client du serveur d'inférence (INFERENCE_MODE=server), même interface que LocalInference
+
+    Une connexion par processus de l'API, partagée par toutes les requêtes : les
+    réponses sont associées aux requêtes par identifiant, plusieurs requêtes peuvent
+    donc être en cours en même temps (une par thread).
+    """
+
+    remote = True
+    # Modèles chargés par les workers (empreinte utilisée par le cache des prédictions)
+    model_files = ("utils/muzzle.keras", "utils/new.pt")
+
+    def __init__(self, address=None, timeout=None):
+        self.address = server_address(address)
+        self.timeout = timeout or float(os.getenv('INFERENCE_TIMEOUT', '30'))
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._pending = {}
+        self._task_ids = itertools.count()
+
+    def _connection(self):
+        with self._lock:
+            # Nouvelle connexion après un fork ou une déconnexion
+            if self._conn is None or self._pid != os.getpid():
+                try:
+                    conn = Client(self.address, authkey=server_authkey(self.address))
+                except OSError as e:
+                    raise InferenceError(f"Serveur d'inférence injoignable ({self.address}): {e}")
+                self._conn, self._pid = conn, os.getpid()
+                threading.Thread(target=self._receive, args=(conn,), name="inference-client", daemon=True).start()
+            return self._conn
+
+    def _receive(self, conn):
+        while True:
+            try:
+                task_id, ok, payload = conn.recv()
+            except (EOFError, OSError):
+                break
+            future = self._pending.pop(task_id, None)
+            if future is None:
+                continue
+            if ok:
+                future.set_result(payload)
+            else:
+                future.set_exception(InferenceError(payload))
+        with self._lock:
+            if self._conn is conn:
+                self._conn = None
+        for task_id in list(self._pending):
+            future = self._pending.pop(task_id, None)
+            if future is not None and not future.done():
+                future.set_exception(InferenceError("Connexion au serveur d'inférence perdue"))
+
+    def _call(self, op, payload, **params):
+        if isinstance(payload, np.ndarray):
+            payload = np.ascontiguousarray(payload)
+            transport = {"kind": "array", "nbytes": payload.nbytes, "shape": payload.shape, "dtype": payload.dtype.str}
+        else:
+            transport = {"kind": "bytes", "nbytes": len(payload)}
+        transport["params"] = params
+
+        shm = shared_memory.SharedMemory(create=True, size=max(transport["nbytes"], 1))
+        transport["shm"] = shm.name
+        task_id = next(self._task_ids)
+        try:
+            if transport["kind"] == "array":
+                target = np.ndarray(payload.shape, dtype=payload.dtype, buffer=shm.buf)
+                target[...] = payload
+                del target
+            else:
+                shm.buf[:transport["nbytes"]] = payload
+
+            future = Future()
+            self._pending[task_id] = future
+            conn = self._connection()
+            try:
+                with self._send_lock:
+                    conn.send((task_id, op, transport))
+            except (OSError, ValueError) as e:
+                with self._lock:
+                    if self._conn is conn:
+                        self._conn = None
+                raise InferenceError(f"Envoi au serveur d'inférence impossible: {e}")
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            raise InferenceError(f"Pas de réponse du serveur d'inférence après {self.timeout}s")
+        finally:
+            self._pending.pop(task_id, None)
+            shm.close()
+            shm.unlink()
+
+    def detect(self, data, conf=0.5):
+        return self._call("detect", data, conf=conf)
+
+    def detect_full_resolution(self, data, conf=0.5):
+        return self._call("detect_full_resolution", data, conf=conf)
+
+    def embed(self, crop):
+        return self._call("embed", crop)
+
+    def predict(self, data, conf=0.5):
+        return self._call("predict", data, conf=conf)
+
+    def stats(self):
+        return {
+            "mode": "server",
+            "address": self.address if isinstance(self.address, str) else f"{self.address[0]}:{self.address[1]}",
+            "connected": self._conn is not None and self._pid == os.getpid(),
+            "pending": len(self._pending)
+        }
+
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv(override=True)
+    logging.basicConfig(level=logging.INFO)
+    # docker stop envoie SIGTERM : arrêt propre des workers
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    server = InferenceServer()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,109 @@
+import os
+import numpy as np
+import cv2
+
+# Largeur de référence pour des mesures de netteté comparables entre crops de tailles différentes
+_REFERENCE_WIDTH = 224
+
+
+def perceptual_hash(gray):
+    """Hash perceptuel (dHash 64 bits) d'une image en niveaux de gris"""
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def hamming_distance(hash_a, hash_b):
+    return bin(hash_a ^ hash_b).count("1")
+
+
+def compute_quality_metrics(img):
+    """
+    Mesures rapides de qualité d'un crop de museau (BGR)
+
+    Returns:
+        dict: width, height, sharpness (variance du laplacien), mean_brightness,
+              dark_ratio / bright_ratio (proportion de pixels sous/sur-exposés), phash
+    """
+    height, width = img.shape[:2]
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+
+    if width != _REFERENCE_WIDTH and width > 0:
+        scale = _REFERENCE_WIDTH / width
+        resized = cv2.resize(gray, (_REFERENCE_WIDTH, max(1, int(round(height * scale)))), interpolation=cv2.INTER_AREA)
+    else:
+        resized = gray
+    sharpness = float(cv2.Laplacian(resized, cv2.CV_64F).var())
+
+    hist = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel()
+    total = max(float(hist.sum()), 1.0)
+    return {
+        "width": int(width),
+        "height": int(height),
+        "sharpness": round(sharpness, 2),
+        "mean_brightness": round(float(np.dot(hist, np.arange(256)) / total), 2),
+        "dark_ratio": round(float(hist[:16].sum() / total), 4),
+        "bright_ratio": round(float(hist[240:].sum() / total), 4),
+        "phash": perceptual_hash(gray)
+    }
+
+
+class QualityGate:
+    """
+    Filtre les crops de museaux inutiles avant le calcul des embeddings :
+    trop petits, flous, mal exposés ou quasi identiques à un crop déjà accepté.
+
+    Une instance par enrôlement (elle mémorise les hash des crops acceptés).
+    Seuils configurables par variables d'environnement.
+    """
+
+    def __init__(self, min_size=None, min_sharpness=None, max_dark_ratio=None,
+                 max_bright_ratio=None, duplicate_distance=None):
+        self.min_size = min_size if min_size is not None else int(os.getenv('QUALITY_MIN_SIZE', '64'))
+        self.min_sharpness = min_sharpness if min_sharpness is not None else float(os.getenv('QUALITY_MIN_SHARPNESS', '30'))
+        self.max_dark_ratio = max_dark_ratio if max_dark_ratio is not None else float(os.getenv('QUALITY_MAX_DARK_RATIO', '0.5'))
+        self.max_bright_ratio = max_bright_ratio if max_bright_ratio is not None else float(os.getenv('QUALITY_MAX_BRIGHT_RATIO', '0.5'))
+        self.duplicate_distance = duplicate_distance if duplicate_distance is not None else int(os.getenv('QUALITY_DUPLICATE_DISTANCE', '4'))
+        self._accepted_hashes = []
+
+    def evaluate(self, img, name=None):
+        """
+        Évalue un crop
+
+        Args:
+            img: Crop BGR
+            name: Identifiant de l'image (pour signaler les doublons)
+
+        Returns:
+            tuple: (accepté, raison du rejet ou None, métriques)
+        """
+        metrics = compute_quality_metrics(img)
+        phash = metrics.pop("phash")
+
+        if min(metrics["width"], metrics["height"]) < self.min_size:
+            return False, f"crop trop petit ({metrics['width']}x{metrics['height']} < {self.min_size}px)", metrics
+        if metrics["dark_ratio"] > self.max_dark_ratio:
+            return False, f"sous-exposée ({metrics['dark_ratio']:.0%} de pixels sombres)", metrics
+        if metrics["bright_ratio"] > self.max_bright_ratio:
+            return False, f"surexposée ({metrics['bright_ratio']:.0%} de pixels saturés)", metrics
+        # Après l'exposition : une image très sombre a aussi une faible variance du laplacien
+        if metrics["sharpness"] < self.min_sharpness:
+            return False, f"image floue (netteté {metrics['sharpness']} < {self.min_sharpness})", metrics
+
+        for accepted_hash, accepted_name in self._accepted_hashes:
+            distance = hamming_distance(phash, accepted_hash)
+            if distance <= self.duplicate_distance:
+                metrics["duplicate_of"] = accepted_name
+                return False, f"quasi-doublon d'une image déjà retenue (distance {distance})", metrics
+
+        self._accepted_hashes.append((phash, name))
+        return True, None, metrics
+
+    def thresholds(self):
+        return {
+            "min_size": self.min_size,
+            "min_sharpness": self.min_sharpness,
+            "max_dark_ratio": self.max_dark_ratio,
+            "max_bright_ratio": self.max_bright_ratio,
+            "duplicate_distance": self.duplicate_distance
+        }
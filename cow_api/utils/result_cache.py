@@ -0,0 +1,80 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+
+def content_hash(data):
+    """Empreinte SHA-256 du contenu brut d'une image"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def model_version(paths):
+    """
+    Version des modèles : MODEL_VERSION si défini, sinon empreinte des fichiers
+    (nom, taille, date de modification) - change dès qu'un modèle est remplacé
+    """
+    version = os.getenv('MODEL_VERSION')
+    if version:
+        return version
+    digest = hashlib.sha1()
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        except FileNotFoundError:
+            digest.update(f"{path}:absent".encode())
+    return digest.hexdigest()[:12]
+
+
+class PredictionCache:
+    """
+    Cache LRU borné des résultats de /predict
+
+    Clé : (empreinte de l'image, version de la base, version des modèles). Un
+    changement de base ou de modèle rend donc les anciennes entrées inaccessibles ;
+    clear() les libère dès que la base change.
+    """
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries if max_entries is not None else int(os.getenv('RESULT_CACHE_SIZE', '1024'))
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def get(self, key):
+        with self._lock:
+            result = self._entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(result)
+
+    def put(self, key, result):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = dict(result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses
+            }
@@ -1,46 +1,48 @@
 import json
-import boto3
 import os
-from botocore.exceptions import ClientError
 import logging
 from dotenv import load_dotenv
+from utils.storage import get_storage, S3Storage, StorageObjectNotFound, StorageObjectExists
 
 logger = logging.getLogger(__name__)
 
 class S3DatabaseManager:
-    def __init__(self, bucket_name=None, region_name='eu-north-1'):
+    def __init__(self, bucket_name=None, region_name='eu-north-1', storage=None):
         """
         Gestionnaire pour la base de données embedding stockée sur S3
+        (ou sur le backend configuré par STORAGE_BACKEND)
         """
         # Forcer le rechargement des variables d'environnement
         load_dotenv(override=True)
         
-        self.bucket_name = bucket_name or os.getenv('AWS_S3_BUCKET', 'boviclouds-cows-imgs')
+        # Backend partagé avec S3Manager (un seul client boto3 / pool de connexions)
+        if storage is None:
+            storage = get_storage()
+            # Sur S3, la base garde son bucket et sa région par défaut historiques
+            # (boviclouds-cows-imgs, eu-north-1) s'ils diffèrent de ceux des images
+            if storage.backend_name == "s3":
+                bucket_name = bucket_name or os.getenv('AWS_S3_BUCKET', 'boviclouds-cows-imgs')
+                if bucket_name != storage.bucket_name or region_name != storage.region_name:
+                    storage = S3Storage(bucket_name=bucket_name, region_name=region_name)
+        self.storage = storage
+        self.bucket_name = bucket_name or self.storage.bucket_name
         self.region_name = region_name
         self.db_key = "database/embedding_database.json"
         self.local_cache = "utils/embedding_database_cache.json"
-        
-        # Initialisation du client S3 avec session explicite
-        try:
-            session = boto3.Session(
-                aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-                aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-                region_name=self.region_name
-            )
-            self.s3_client = session.client('s3')
-        except Exception as e:
-            logger.error(f"Erreur lors de l'initialisation du client S3: {e}")
-            raise
+        self.changes_prefix = "database/changes/"
+        self.journal_keep = int(os.getenv('DB_JOURNAL_KEEP', '1000'))
+        self._info_cache = None
+    
+    @property
+    def location(self):
+        """Emplacement de la base de données (s3://bucket/clé, file://...)"""
+        return self.storage.uri(self.db_key)
     
     def load_database(self):
         """Charge la base de données depuis S3 avec cache local"""
         try:
             # Essayer de charger depuis S3
-            response = self.s3_client.get_object(
-                Bucket=self.bucket_name,
-                Key=self.db_key
-            )
-            content = response['Body'].read().decode('utf-8')
+            content = self.storage.get_object(self.db_key).decode('utf-8')
             database = json.loads(content)
             
             # Sauvegarder en cache local
@@ -51,17 +53,12 @@ class S3DatabaseManager:
             logger.info(f"Base de données chargée depuis S3: {self.db_key}")
             return database
             
-        except ClientError as e:
-            if e.response['Error']['Code'] == 'NoSuchKey':
-                # Base de données n'existe pas encore, créer une nouvelle
-                logger.info("Création d'une nouvelle base de données")
-                new_db = {"labels": [], "embeddings": []}
-                self.save_database(new_db)
-                return new_db
-            else:
-                # Erreur S3, ne pas utiliser le cache local - faire échouer
-                logger.error(f"Erreur S3: {e}")
-                raise Exception(f"Impossible d'accéder à S3: {e}")
+        except StorageObjectNotFound:
+            # Base de données n'existe pas encore, créer une nouvelle
+            logger.info("Création d'une nouvelle base de données")
+            new_db = {"labels": [], "embeddings": []}
+            self.save_database(new_db)
+            return new_db
         except Exception as e:
             logger.error(f"Erreur lors du chargement depuis S3: {e}")
             raise Exception(f"Impossible de charger la base de données depuis S3: {e}")
@@ -74,18 +71,14 @@ class S3DatabaseManager:
             
             # Sauvegarder sur S3
             json_content = json.dumps(clean_database, indent=2)
-            self.s3_client.put_object(
-                Bucket=self.bucket_name,
-                Key=self.db_key,
-                Body=json_content,
-                ContentType='application/json'
-            )
+            self.storage.put_object(self.db_key, json_content, content_type='application/json')
             
             # Sauvegarder en cache local
             os.makedirs(os.path.dirname(self.local_cache), exist_ok=True)
             with open(self.local_cache, 'w') as f:
                 json.dump(clean_database, f, indent=2)
             
+            self._info_cache = None
             logger.info(f"Base de données sauvegardée sur S3: {self.db_key}")
             return True
             
@@ -106,10 +99,19 @@ class S3DatabaseManager:
         """Nettoie la base de données pour la serialisation JSON"""
         import numpy as np
         
+        if hasattr(database, "to_dict"):
+            database = database.to_dict()
+        
         clean_db = {
             "labels": database.get("labels", []),
             "embeddings": []
         }
+        if "metadata" in database:
+            clean_db["metadata"] = database["metadata"]
+        if "version" in database:
+            clean_db["version"] = database["version"]
+        if "calibration" in database:
+            clean_db["calibration"] = database["calibration"]
         
         for emb in database.get("embeddings", []):
             if isinstance(emb, np.ndarray):
@@ -142,42 +144,140 @@ class S3DatabaseManager:
             backup_key = f"database/backups/embedding_database_{timestamp}.json"
             
             # Copier la base actuelle vers le backup
-            copy_source = {
-                'Bucket': self.bucket_name,
-                'Key': self.db_key
-            }
-            self.s3_client.copy_object(
-                CopySource=copy_source,
-                Bucket=self.bucket_name,
-                Key=backup_key
-            )
+            self.storage.copy_object(self.db_key, backup_key)
             logger.info(f"Backup créé: {backup_key}")
             return backup_key
         except Exception as e:
             logger.error(f"Erreur lors du backup: {e}")
             return None
     
-    def get_database_info(self):
-        """Informations sur la base de données"""
+    def invalidate_info_cache(self):
+        """Oublie les informations mises en cache par get_database_info"""
+        self._info_cache = None
+
+    def get_database_info(self, use_cache=False):
+        """
+        Informations sur la base de données
+        
+        Args:
+            use_cache: Réutiliser les dernières informations lues (invalidées à chaque sauvegarde
+                       ou nouvelle version distante, voir invalidate_info_cache)
+        """
+        if use_cache and self._info_cache is not None:
+            return self._info_cache
         try:
-            response = self.s3_client.head_object(
-                Bucket=self.bucket_name,
-                Key=self.db_key
-            )
-            return {
+            head = self.storage.head_object(self.db_key)
+            self._info_cache = {
                 "exists": True,
-                "last_modified": response['LastModified'],
-                "size": response['ContentLength'],
-                "location": f"s3://{self.bucket_name}/{self.db_key}"
+                "last_modified": head['last_modified'],
+                "size": head['size'],
+                "location": self.location
             }
-        except ClientError as e:
-            if e.response['Error']['Code'] == 'NoSuchKey':
-                return {
-                    "exists": False,
-                    "location": f"s3://{self.bucket_name}/{self.db_key}"
-                }
-            else:
-                return {"error": str(e)}
+            return self._info_cache
+        except StorageObjectNotFound:
+            return {
+                "exists": False,
+                "location": self.location
+            }
+        except Exception as e:
+            return {"error": str(e)}
+
+    def get_remote_version(self):
+        """
+        Version de la base sur S3 sans la télécharger (HEAD)
+        
+        Returns:
+            dict: {"etag", "last_modified"}, None si la base n'existe pas
+        """
+        try:
+            head = self.storage.head_object(self.db_key)
+        except StorageObjectNotFound:
+            return None
+        return {"etag": head['etag'], "last_modified": head['last_modified']}
+    
+    def _change_key(self, version):
+        return f"{self.changes_prefix}{version:012d}.json"
+    
+    def record_change(self, version, operations):
+        """
+        Enregistre dans le journal les modifications qui produisent la version donnée
+        (écrit avant la base complète, pour que les autres nœuds puissent appliquer
+        seulement les changements)
+        
+        L'entrée est créée de façon conditionnelle : si un autre nœud a déjà écrit
+        cette version, StorageObjectExists est levée et rien n'est écrit. Toute autre
+        erreur est aussi propagée : sans entrée dans le journal, la version n'est pas
+        réservée et la base complète ne doit pas être publiée.
+        
+        Args:
+            version: Numéro de version atteint après ces opérations
+            operations: [{"op": "add", "label", "embedding", "metadata"} | {"op": "remove", "label"}]
+        """
+        try:
+            self.storage.put_object(
+                self._change_key(version),
+                json.dumps({"version": version, "operations": operations}),
+                content_type='application/json',
+                if_none_match=True
+            )
+        except StorageObjectExists:
+            logger.warning(f"Version {version} déjà écrite dans le journal par un autre nœud")
+            raise
+        except Exception as e:
+            logger.error(f"Erreur lors de l'écriture du journal (version {version}): {e}")
+            raise
+        if version % 100 == 0:
+            self.prune_changes(version)
+        return True
+    
+    def change_exists(self, version):
+        """Vrai si l'entrée du journal de cette version existe (HEAD)"""
+        try:
+            self.storage.head_object(self._change_key(version))
+        except StorageObjectNotFound:
+            return False
+        return True
+    
+    def load_changes(self, since_version):
+        """
+        Modifications enregistrées après since_version
+        
+        Returns:
+            list: [(version, operations)] triée, None si le journal est incomplet
+                  (rechargement complet nécessaire)
+        """
+        versions = []
+        for key in self.storage.list_objects(self.changes_prefix):
+            name = key[len(self.changes_prefix):]
+            if name.endswith('.json') and name[:-5].isdigit():
+                version = int(name[:-5])
+                if version > since_version:
+                    versions.append(version)
+        versions.sort()
+        
+        # Le journal doit être continu à partir de since_version + 1
+        if versions and versions != list(range(since_version + 1, since_version + 1 + len(versions))):
+            return None
+        
+        changes = []
+        for version in versions:
+            try:
+                entry = json.loads(self.storage.get_object(self._change_key(version)).decode('utf-8'))
+            except StorageObjectNotFound:
+                return None
+            changes.append((version, entry.get("operations", [])))
+        return changes
+    
+    def prune_changes(self, version):
+        """Supprime les entrées du journal plus anciennes que journal_keep versions"""
+        oldest = version - self.journal_keep
+        try:
+            for key in self.storage.list_objects(self.changes_prefix):
+                name = key[len(self.changes_prefix):]
+                if name.endswith('.json') and name[:-5].isdigit() and int(name[:-5]) <= oldest:
+                    self.storage.delete_object(key)
+        except Exception as e:
+            logger.warning(f"Impossible de nettoyer le journal: {e}")
 
 # Instance globale du gestionnaire de base de données
 db_manager = S3DatabaseManager()
@@ -0,0 +1,418 @@
+import hashlib
+import os
+import threading
+from datetime import datetime, timezone
+import logging
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+
+class StorageObjectNotFound(Exception):
+    """Levée quand une clé n'existe pas dans le backend de stockage"""
+
+
+class StorageObjectExists(Exception):
+    """Levée par put_object(..., if_none_match=True) quand la clé existe déjà"""
+
+
+class StorageBackend:
+    """
+    Interface commune des backends de stockage d'objets (S3, dossier local, mémoire)
+
+    Les clés sont des chemins de type S3 ("cow_1/img.jpg", "database/x.json").
+    """
+
+    backend_name = "abstract"
+
+    def __init__(self, bucket_name):
+        self.bucket_name = bucket_name
+
+    def get_object(self, key):
+        """Retourne le contenu (bytes) de l'objet, lève StorageObjectNotFound s'il n'existe pas"""
+        raise NotImplementedError
+
+    def put_object(self, key, body, content_type=None, if_none_match=False):
+        """
+        Écrit l'objet (bytes ou str)
+
+        Args:
+            if_none_match: Création seulement - lève StorageObjectExists si la clé existe
+                déjà (écriture conditionnelle atomique, If-None-Match: * sur S3)
+        """
+        raise NotImplementedError
+
+    def list_objects(self, prefix=""):
+        """Liste toutes les clés commençant par prefix"""
+        raise NotImplementedError
+
+    def copy_object(self, source_key, dest_key):
+        """Copie un objet vers une nouvelle clé"""
+        raise NotImplementedError
+
+    def delete_object(self, key):
+        """Supprime un objet (sans erreur s'il n'existe pas)"""
+        raise NotImplementedError
+
+    def head_object(self, key):
+        """
+        Métadonnées d'un objet
+
+        Returns:
+            dict: {"size", "last_modified", "etag"} - lève StorageObjectNotFound s'il n'existe pas
+        """
+        raise NotImplementedError
+
+    def check_access(self):
+        """Vérifie que le stockage est accessible (lève une exception sinon)"""
+        raise NotImplementedError
+
+    def ensure_bucket(self):
+        """Crée le conteneur de stockage s'il n'existe pas"""
+        raise NotImplementedError
+
+    def uri(self, key):
+        """URI lisible de l'objet (pour les réponses de l'API et les logs)"""
+        return f"{self.backend_name}://{self.bucket_name}/{key}"
+
+    def public_url(self, key):
+        """URL d'accès à l'objet"""
+        return self.uri(key)
+
+    @staticmethod
+    def _to_bytes(body):
+        if isinstance(body, str):
+            return body.encode("utf-8")
+        return bytes(body)
+
+
+# Clients boto3 partagés par tous les gestionnaires (un pool de connexions par région)
+_s3_clients = {}
+_s3_client_lock = threading.Lock()
+
+
+def get_s3_client(region_name=None):
+    """
+    Retourne le client S3 partagé pour une région (défaut: AWS_REGION, sinon us-east-1),
+    créé une seule fois avec un pool de connexions et une politique de retry
+    configurables (S3_MAX_POOL_CONNECTIONS, S3_MAX_ATTEMPTS)
+    """
+    region_name = region_name or os.getenv('AWS_REGION', 'us-east-1')
+    client = _s3_clients.get(region_name)
+    if client is not None:
+        return client
+
+    with _s3_client_lock:
+        if region_name not in _s3_clients:
+            import boto3
+            from botocore.config import Config
+
+            config = Config(
+                max_pool_connections=int(os.getenv('S3_MAX_POOL_CONNECTIONS', '32')),
+                retries={
+                    'max_attempts': int(os.getenv('S3_MAX_ATTEMPTS', '5')),
+                    'mode': 'adaptive'
+                },
+                connect_timeout=float(os.getenv('S3_CONNECT_TIMEOUT', '5')),
+                read_timeout=float(os.getenv('S3_READ_TIMEOUT', '30'))
+            )
+            session = boto3.Session(
+                aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+                aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+                region_name=region_name
+            )
+            _s3_clients[region_name] = session.client('s3', config=config)
+            logger.info(f"Client S3 partagé initialisé ({region_name}, pool: {config.max_pool_connections} connexions)")
+    return _s3_clients[region_name]
+
+
+class S3Storage(StorageBackend):
+    backend_name = "s3"
+
+    def __init__(self, bucket_name=None, region_name=None, client=None):
+        super().__init__(bucket_name or os.getenv('AWS_S3_BUCKET', 'cow-muzzle-images'))
+        self.region_name = region_name or os.getenv('AWS_REGION', 'us-east-1')
+        self.client = client or get_s3_client(self.region_name)
+
+    @staticmethod
+    def _is_not_found(error):
+        return error.response['Error']['Code'] in ('NoSuchKey', '404', 'NotFound')
+
+    def get_object(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            response = self.client.get_object(Bucket=self.bucket_name, Key=key)
+            return response['Body'].read()
+        except ClientError as e:
+            if self._is_not_found(e):
+                raise StorageObjectNotFound(key) from e
+            raise
+
+    def put_object(self, key, body, content_type=None, if_none_match=False):
+        from botocore.exceptions import ClientError
+        kwargs = {"Bucket": self.bucket_name, "Key": key, "Body": self._to_bytes(body)}
+        if content_type:
+            kwargs["ContentType"] = content_type
+        if if_none_match:
+            kwargs["IfNoneMatch"] = "*"
+        try:
+            self.client.put_object(**kwargs)
+        except ClientError as e:
+            # 412 : la clé existe ; 409 : une autre écriture conditionnelle de la même clé est en cours
+            if if_none_match and e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise StorageObjectExists(key) from e
+            raise
+
+    def list_objects(self, prefix=""):
+        keys = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                keys.append(obj['Key'])
+        return keys
+
+    def copy_object(self, source_key, dest_key):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.copy_object(
+                CopySource={'Bucket': self.bucket_name, 'Key': source_key},
+                Bucket=self.bucket_name,
+                Key=dest_key
+            )
+        except ClientError as e:
+            if self._is_not_found(e):
+                raise StorageObjectNotFound(source_key) from e
+            raise
+
+    def delete_object(self, key):
+        self.client.delete_object(Bucket=self.bucket_name, Key=key)
+
+    def head_object(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            response = self.client.head_object(Bucket=self.bucket_name, Key=key)
+        except ClientError as e:
+            if self._is_not_found(e):
+                raise StorageObjectNotFound(key) from e
+            raise
+        return {
+            "size": response['ContentLength'],
+            "last_modified": response['LastModified'],
+            "etag": response.get('ETag', '').strip('"')
+        }
+
+    def check_access(self):
+        self.client.head_bucket(Bucket=self.bucket_name)
+
+    def ensure_bucket(self):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_bucket(Bucket=self.bucket_name)
+            logger.info(f"Le bucket {self.bucket_name} existe déjà")
+        except ClientError as e:
+            error_code = int(e.response['Error']['Code'])
+            if error_code == 404:
+                try:
+                    if self.region_name == 'us-east-1':
+                        self.client.create_bucket(Bucket=self.bucket_name)
+                    else:
+                        self.client.create_bucket(
+                            Bucket=self.bucket_name,
+                            CreateBucketConfiguration={'LocationConstraint': self.region_name}
+                        )
+                    logger.info(f"Bucket {self.bucket_name} créé avec succès")
+                except ClientError as create_error:
+                    logger.error(f"Erreur lors de la création du bucket: {create_error}")
+                    raise
+            else:
+                logger.error(f"Erreur lors de la vérification du bucket: {e}")
+                raise
+
+    def public_url(self, key):
+        return f"https://{self.bucket_name}.s3.{self.region_name}.amazonaws.com/{key}"
+
+
+class LocalStorage(StorageBackend):
+    """Backend sur un dossier local : root_dir/bucket_name/<clé>"""
+
+    backend_name = "local"
+
+    def __init__(self, root_dir=None, bucket_name=None):
+        super().__init__(bucket_name or os.getenv('AWS_S3_BUCKET', 'cow-muzzle-images'))
+        self.root_dir = os.path.abspath(root_dir or os.getenv('LOCAL_STORAGE_DIR', 'storage'))
+        self.base_dir = os.path.join(self.root_dir, self.bucket_name)
+
+    def _path(self, key):
+        path = os.path.abspath(os.path.join(self.base_dir, key))
+        if os.path.commonpath([path, self.base_dir]) != self.base_dir:
+            raise ValueError(f"Clé invalide: {key}")
+        return path
+
+    def get_object(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except (FileNotFoundError, IsADirectoryError) as e:
+            raise StorageObjectNotFound(key) from e
+
+    def put_object(self, key, body, content_type=None, if_none_match=False):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Écriture atomique : fichier temporaire puis renommage
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp_path, 'wb') as f:
+            f.write(self._to_bytes(body))
+        if not if_none_match:
+            os.replace(tmp_path, path)
+            return
+        # Création seulement : le lien physique échoue si la clé existe déjà
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError as e:
+            raise StorageObjectExists(key) from e
+        finally:
+            os.remove(tmp_path)
+
+    def list_objects(self, prefix=""):
+        keys = []
+        if not os.path.isdir(self.base_dir):
+            return keys
+        # Ne parcourir que le sous-dossier concerné par le préfixe
+        walk_root = self.base_dir
+        prefix_dir = os.path.dirname(prefix)
+        if prefix_dir:
+            walk_root = self._path(prefix_dir)
+            if not os.path.isdir(walk_root):
+                return keys
+        for dirpath, _, filenames in os.walk(walk_root):
+            for filename in filenames:
+                if '.tmp-' in filename:
+                    continue
+                rel = os.path.relpath(os.path.join(dirpath, filename), self.base_dir)
+                key = rel.replace(os.sep, '/')
+                if key.startswith(prefix):
+                    keys.append(key)
+        keys.sort()
+        return keys
+
+    def copy_object(self, source_key, dest_key):
+        self.put_object(dest_key, self.get_object(source_key))
+
+    def delete_object(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def head_object(self, key):
+        try:
+            stat = os.stat(self._path(key))
+        except FileNotFoundError as e:
+            raise StorageObjectNotFound(key) from e
+        return {
+            "size": stat.st_size,
+            "last_modified": datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc),
+            "etag": f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+        }
+
+    def check_access(self):
+        if not os.path.isdir(self.base_dir):
+            raise FileNotFoundError(f"Dossier de stockage introuvable: {self.base_dir}")
+
+    def ensure_bucket(self):
+        os.makedirs(self.base_dir, exist_ok=True)
+
+    def uri(self, key):
+        return f"file://{os.path.join(self.base_dir, key)}"
+
+
+class MemoryStorage(StorageBackend):
+    """Backend en mémoire (tests de charge, développement) - rien n'est persisté"""
+
+    backend_name = "memory"
+
+    def __init__(self, bucket_name=None):
+        super().__init__(bucket_name or os.getenv('AWS_S3_BUCKET', 'cow-muzzle-images'))
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def get_object(self, key):
+        with self._lock:
+            if key not in self._objects:
+                raise StorageObjectNotFound(key)
+            return self._objects[key]["body"]
+
+    def put_object(self, key, body, content_type=None, if_none_match=False):
+        data = self._to_bytes(body)
+        with self._lock:
+            if if_none_match and key in self._objects:
+                raise StorageObjectExists(key)
+            self._objects[key] = {
+                "body": data,
+                "content_type": content_type,
+                "last_modified": datetime.now(timezone.utc),
+                "etag": hashlib.md5(data).hexdigest()
+            }
+
+    def list_objects(self, prefix=""):
+        with self._lock:
+            return sorted(key for key in self._objects if key.startswith(prefix))
+
+    def copy_object(self, source_key, dest_key):
+        self.put_object(dest_key, self.get_object(source_key))
+
+    def delete_object(self, key):
+        with self._lock:
+            self._objects.pop(key, None)
+
+    def head_object(self, key):
+        with self._lock:
+            if key not in self._objects:
+                raise StorageObjectNotFound(key)
+            obj = self._objects[key]
+            return {
+                "size": len(obj["body"]),
+                "last_modified": obj["last_modified"],
+                "etag": obj["etag"]
+            }
+
+    def check_access(self):
+        return None
+
+    def ensure_bucket(self):
+        return None
+
+
+_BACKENDS = {
+    "s3": S3Storage,
+    "local": LocalStorage,
+    "memory": MemoryStorage,
+}
+
+_default_storage = None
+_default_storage_lock = threading.Lock()
+
+
+def create_storage(backend=None, **kwargs):
+    """
+    Crée un backend de stockage
+
+    Args:
+        backend: "s3", "local" ou "memory" (défaut: variable d'environnement STORAGE_BACKEND, sinon "s3")
+    """
+    load_dotenv(override=True)
+    name = (backend or os.getenv('STORAGE_BACKEND', 's3')).lower()
+    if name not in _BACKENDS:
+        raise ValueError(f"Backend de stockage inconnu: {name} (attendu: {', '.join(_BACKENDS)})")
+    return _BACKENDS[name](**kwargs)
+
+
+def get_storage():
+    """Retourne le backend de stockage partagé par l'application"""
+    global _default_storage
+    if _default_storage is None:
+        with _default_storage_lock:
+            if _default_storage is None:
+                _default_storage = create_storage()
+                logger.info(f"Backend de stockage: {_default_storage.backend_name} ({_default_storage.bucket_name})")
+    return _default_storage